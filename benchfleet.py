@@ -0,0 +1,153 @@
+#!/usr/bin/python
+#
+# End-to-end benchmark with a synthetic fleet of nodes on localhost. A
+# sender process plays thousands of nodemc reporters with their own
+# nodenames and metric dynamics, a listener process runs MyListener, and
+# this process runs the pygui ingest path headlessly into a NodeModel.
+# The results are printed as JSON so throughput regressions can be caught
+# before deploying to the cluster.
+#
+# Usage: benchfleet.py [nodes [rate [duration [table|queue [output.json]]]]]
+#        rate is the num of reports per node per second.
+#
+
+import sys
+import json
+import time
+import math
+import random
+import socket
+import resource
+import threading
+from centermc import *
+from ingest import Ingest
+from model import NodeModel
+from wire import Encoder
+
+BENCH_PORT = 15212
+
+class SimNode(object):
+    """A node with mean-reverting load and bursty network traffic."""
+    def __init__(self, id):
+        self.encoder = Encoder()
+        self.cpu_count = random.choice([8, 16, 32])
+        self.mem_total = self.cpu_count * 2048
+        self.load = random.uniform(0, self.cpu_count)
+        self.bursting = False
+        self.rx_bytes, self.tx_bytes = 0, 0
+        self.stats = { "type": "node", "nodename": "sim%05i" % (id+1), "user_count": 1,
+                       "cpu_count": self.cpu_count, "mem_total": self.mem_total, "disk_pct": 40 }
+        pass
+
+    def report(self, dt):
+        self.load += 0.1*(self.cpu_count/2.0 - self.load)*dt + random.gauss(0, 0.3)
+        self.load = max(self.load, 0)
+        if random.random() < 0.05*dt:
+            self.bursting = not self.bursting
+        rr = random.expovariate(1.0 / (50*2**20 if self.bursting else 2**15))
+        tr = random.expovariate(1.0 / (20*2**20 if self.bursting else 2**14))
+        self.rx_bytes += int(rr*dt)
+        self.tx_bytes += int(tr*dt)
+        s = self.stats
+        s["timestamp"] = time.time()
+        s["load"] = self.load
+        s["mem_used"] = min(self.mem_total, int(self.mem_total*min(self.load/self.cpu_count, 1.0)))
+        s["rx_bytes"], s["tx_bytes"] = self.rx_bytes, self.tx_bytes
+        s["rr"], s["tr"] = int(rr), int(tr)
+        return self.encoder.encode(s)
+
+    pass
+
+def run_fleet(nodes, rate, duration, results):
+    """Send rate reports per node per second, spread over each interval."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4*2**20)
+    fleet = [ SimNode(i) for i in range(nodes) ]
+    interval = 1.0 / rate
+    chunk = max(nodes / 100, 1)
+    sent = 0
+    t0 = time.time()
+    while time.time() - t0 < duration:
+        tick = time.time()
+        for i in range(0, nodes, chunk):
+            for node in fleet[i:i+chunk]:
+                sock.sendto(node.report(interval), ("127.0.0.1", BENCH_PORT))
+                sent += 1
+            delay = tick + interval*(i+chunk)/nodes - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    results.put(("fleet", { "sent": sent, "elapsed": time.time() - t0 }))
+
+def run_listener(use_table, duration, results):
+    listener = MyListener("127.0.0.1", BENCH_PORT, False, table=STATE if use_table else None)
+    t = threading.Thread(target=listener.listen_forever, args=())
+    t.daemon = True
+    t.start()
+    time.sleep(duration)
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    counters = listener.counters()
+    counters["cpu"] = ru.ru_utime + ru.ru_stime
+    results.put(("listener", counters))
+
+def percentiles(values, ps=(50, 90, 95, 99)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return dict(("p%i" % p, values[min(int(math.ceil(p/100.0*len(values))) - 1, len(values)-1)]) for p in ps)
+
+def run(nodes=1000, rate=1.0, duration=10, mode="table"):
+    use_table = mode == "table"
+    results = Queue()
+    listener = Process(target=run_listener, args=(use_table, duration + 2, results))
+    listener.start()
+    time.sleep(0.5)
+    fleet = Process(target=run_fleet, args=(nodes, rate, duration, results))
+    fleet.start()
+    model = NodeModel(nodes)
+    lock = threading.Lock()
+    latencies, depths = [], []
+    def apply(slot, data):
+        model.update(slot, data)
+        latencies.append(time.time() - data["timestamp"])
+    ingest = Ingest(STATE if use_table else None, None if use_table else INCQUE,
+                    [ ("sim%05i" % (i+1), i) for i in range(nodes) ])
+    ru0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.time()
+    while time.time() - t0 < duration + 1.5:
+        if not use_table:
+            depths.append(INCQUE.qsize())
+        ingest.run_once(lock, apply)
+        time.sleep(0.01)
+    ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    out = dict(results.get() for i in range(2))
+    fleet.join()
+    listener.join()
+    sent = out["fleet"]["sent"]
+    received = out["listener"]["received"]
+    return { "nodes": nodes, "rate": rate, "duration": duration, "mode": mode,
+             "sent": sent,
+             "sent_per_s": sent / out["fleet"]["elapsed"],
+             "received": received,
+             "received_per_s": received / out["fleet"]["elapsed"],
+             "loss": max(sent - received, 0) / float(max(sent, 1)),
+             "kernel_drops": out["listener"]["kernel_drops"],
+             "queue_drops": out["listener"]["queue_drops"],
+             "decode_errors": out["listener"]["decode_errors"],
+             "listener_cpu_us_per_msg": 1e6 * out["listener"]["cpu"] / max(received, 1),
+             "ingest_cpu_us_per_msg": 1e6 * (ru1.ru_utime + ru1.ru_stime - ru0.ru_utime - ru0.ru_stime) / max(ingest.applied, 1),
+             "applied": ingest.applied,
+             "coalesced": ingest.coalesced,
+             "incque_depth_max": max(depths) if depths else 0,
+             "latency_s": percentiles(latencies) }
+
+if __name__=="__main__":
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    mode = sys.argv[4] if len(sys.argv) > 4 else "table"
+    report = run(nodes, rate, duration, mode)
+    s = json.dumps(report, indent=2, sort_keys=True)
+    if len(sys.argv) > 5:
+        open(sys.argv[5], "w").write(s + "\n")
+    print s
+    sys.exit(0)
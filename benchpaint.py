@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Benchmark of painting the pygui tiles into an off-screen bitmap: the old
+# way, one DrawRectangle per history bar with new fonts and pens for every
+# tile, against the batched DrawRectangleList path of render.py.
+#
+# Usage: benchpaint.py [frames] [matrix_x] [matrix_y]
+#
+
+import wx
+import sys
+import time
+import numpy
+from render import DrawCache, DrawBatch, bar_rects
+from history import SpeedHistory
+
+W, H = 1600, 1200
+
+def make_tiles(mx, my):
+    tiles = []
+    nw, nh = W/mx - 2, H/my - 2
+    r = 3
+    for i in range(my):
+        for j in range(mx):
+            history = SpeedHistory(nw/r)
+            for v in numpy.random.exponential(2**20, size=(nw/r, 2)):
+                history.record(v[0], v[1])
+            tiles.append(((nw+2)*j+2, (nh+2)*i+2, nw, nh, r, history))
+    return tiles
+
+def legacy_paint(dc, tiles, norm):
+    for x, y, w, h, r, history in tiles:
+        dc.SetFont(wx.Font(8, wx.FONTFAMILY_SWISS,wx.FONTSTYLE_NORMAL,wx.FONTWEIGHT_NORMAL))
+        dc.DrawText("n000", x+1, y)
+        for values, brush, rd in ((history.a.values(), wx.GREEN_BRUSH, int(r/2)),
+                                  (history.b.values(), wx.RED_BRUSH, 0)):
+            dc.SetPen(wx.Pen("cyan", 0, wx.TRANSPARENT))
+            dc.SetBrush(brush)
+            for i in range(1, len(values)):
+                vh = int(h*values[-i]/norm)
+                dc.DrawRectangle(x + w - i*r - rd, y + h - vh, r-1, vh)
+        dc.SetPen(wx.Pen(wx.Colour(64,64,64), 1))
+        dc.SetBrush(wx.TRANSPARENT_BRUSH)
+        dc.DrawRectangle(x, y, w, h)
+    pass
+
+def batched_paint(dc, tiles, norm, cache):
+    batch = DrawBatch(cache)
+    dc.SetFont(cache.font)
+    for x, y, w, h, r, history in tiles:
+        dc.DrawText("n000", x+1, y)
+        batch.add("none", "green", bar_rects(history.a.values(), x, y, w, h, r, norm, int(r/2)))
+        batch.add("none", "red", bar_rects(history.b.values(), x, y, w, h, r, norm))
+        batch.add("frame", "none", (x, y, w, h))
+    batch.flush(dc)
+    pass
+
+def measure(paint, frames, *args):
+    t0 = time.time()
+    for i in range(frames):
+        paint(*args)
+    return (time.time() - t0) / frames
+
+if __name__=="__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    mx = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    my = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+    app = wx.App(False)
+    bmp = wx.EmptyBitmap(W, H)
+    dc = wx.MemoryDC(bmp)
+    tiles = make_tiles(mx, my)
+    norm = 3.5*max(t[-1].norm() for t in tiles)
+    cache = DrawCache()
+    cache.rebuild(8)
+    before = measure(legacy_paint, frames, dc, tiles, norm)
+    after = measure(batched_paint, frames, dc, tiles, norm, cache)
+    print "%i tiles, %i frames" % (len(tiles), frames)
+    print "per-rectangle: %.2f ms/frame" % (before*1000)
+    print "batched:       %.2f ms/frame" % (after*1000)
+    print "speedup:       %.1fx" % (before/after)
+    dc.SelectObject(wx.NullBitmap)
@@ -14,9 +14,12 @@ import time
 import threading
 import multiprocessing
 from centermc import *
+from history import SpeedHistory
+from render import DrawCache, DrawBatch, bar_rects
 
 BTNID_START = 5
 NLISTID = 10
+FILTER = NameFilter([])         # Nodes whose peers the listener passes on
 
 class Node(object):
     def __init__(self, id):
@@ -34,25 +37,24 @@ class PeerPanel(object):
         self.parent = parent
         self.x, self.y, self.w, self.h = 0, 0, 0, 0
         self.r, self.rn = 3, 60
-        self.ul_history = [1]
-        self.dl_history = [1]
+        self.history = SpeedHistory(self.rn)
         self.ul_norm = 10
         self.dl_norm = 10
         pass
 
-    def update(self, peer, dc):
+    def update(self, peer, dc, batch):
+        """Draw the text, and add the curve and the frame to batch. The
+        percentage bar goes under the text, see InfoPanel.update."""
         x, y, w, h = self.x, self.y, self.w, self.h
         fz = int(h/12.0)
-        self.draw_percentage_bar(peer, dc)
-        dc.SetFont(wx.Font(fz, wx.FONTFAMILY_SWISS,wx.FONTSTYLE_NORMAL,wx.FONTWEIGHT_NORMAL))
         dc.SetTextForeground(wx.Colour(0,255,0,alpha=255))
         dc.DrawText(peer["peer"], x+4, y)
         dc.DrawText("ac:%i  uc:%i  tc:%i" % (peer["ac"], peer["uc"], peer["tc"]), x+4, y+fz+4)
         dc.DrawText("uz:%iMB  dz:%iMB\n" % (peer["ul_size"]/2**20, peer["dl_size"]/2**20), x+4, y+2*(fz+4))
         dc.DrawText("ul:%iKB/s  dl:%iKB/s\n" % (peer["ul_rate"]/1024, peer["dl_rate"]/1024), x+4, y+3*(fz+4))
         self.draw_extra_info(peer, dc)
-        self.draw_speed_curve(peer, dc)
-        self.draw_panel_frame(dc)
+        self.draw_speed_curve(peer, batch)
+        self.draw_panel_frame(batch)
         pass
 
     def draw_extra_info(self, peer, dc):
@@ -71,47 +73,26 @@ class PeerPanel(object):
         dc.DrawText(s, x+w-(len(s))*fz-2, y+fz+4)
         pass
 
-    def draw_panel_frame(self, dc):
-        x, y, w, h = self.x, self.y, self.w, self.h
-        dc.SetPen(wx.Pen('grey', 1))
-        dc.SetBrush(wx.TRANSPARENT_BRUSH)
-        dc.DrawRectangle(x, y, w, h)
+    def draw_panel_frame(self, batch):
+        batch.add("grey", "none", (self.x, self.y, self.w, self.h))
+        pass
+
+    def record(self, peer):
+        self.history.record(peer["ul_rate"]/1024, peer["dl_rate"]/1024)
         pass
 
-    def draw_speed_curve(self, peer, dc):
+    def draw_speed_curve(self, peer, batch):
         x, y, w, h, r = self.x, self.y, self.w, self.h, self.r
-        rn = int(w/r)
-        self.ul_history.append(peer["ul_rate"]/1024)
-        self.dl_history.append(peer["dl_rate"]/1024)
-        norm = max(max(self.ul_history), max(self.dl_history))
+        norm = self.history.norm()
         self.parent.norm = max(norm, self.parent.norm)
         norm = self.parent.norm
-        self.ul_history = self.ul_history[-rn:]
-        self.dl_history = self.dl_history[-rn:]
-        dc.SetPen(wx.Pen("cyan", 0, wx.TRANSPARENT))
-        dc.SetBrush(wx.GREEN_BRUSH)
-        for i in range(1, len(self.dl_history)):
-            dl = self.dl_history[-i]
-            dh = int(h*dl/(2*norm))
-            dy = y + h - dh
-            dx = x + w - i*r
-            sd = int(r/2)
-            dc.DrawRectangle(dx-sd, dy, r-1, dh)
-        dc.SetPen(wx.Pen("cyan", 0, wx.TRANSPARENT))
-        dc.SetBrush(wx.RED_BRUSH)
-        for i in range(1, len(self.ul_history)):
-            ul = self.ul_history[-i]
-            uh = int(h*ul/(2*norm))
-            uy = y + h - uh
-            ux = x + w - i*r
-            dc.DrawRectangle(ux, uy, r-1, uh)
+        batch.add("none", "green", bar_rects(self.history.b.values(), x, y, w, h, r, 2*norm, int(r/2)))
+        batch.add("none", "red", bar_rects(self.history.a.values(), x, y, w, h, r, 2*norm))
         pass
 
-    def draw_percentage_bar(self, peer, dc):
+    def draw_percentage_bar(self, peer, batch):
         x, y, w, h = self.x, self.y, self.w, self.h
-        dc.SetPen(wx.Pen("cyan", 0, wx.TRANSPARENT))
-        dc.SetBrush(wx.Brush(wx.Colour(0,0,255),wx.SOLID))
-        dc.DrawRectangle(x, y, w*peer["dl_size"]/(2044*2**20), int(h/12.0)+2)
+        batch.add("none", "blue", (x, y, w*peer["dl_size"]/(2044*2**20), int(h/12.0)+2))
         pass
 
     pass
@@ -143,11 +124,14 @@ class InfoPanel(object):
         self.matrix_x, self.matrix_y = 12, 10
         self.panellist = [ PeerPanel(i,self) for i in range(self.matrix_x*self.matrix_y) ]
         self.norm = 10
+        self.cache = DrawCache()
+        self.cache.rebuild(8)
         pass
 
     def update_size(self, x, y, w, h):
         scrW, scrH = w, h
         w, h = scrW/self.matrix_x - 4, scrH/self.matrix_y - 4
+        self.cache.rebuild(h/12.0)
         for i in range(self.matrix_y):
             for j in range(self.matrix_x):
                 id = i*self.matrix_x+j
@@ -155,14 +139,22 @@ class InfoPanel(object):
                 panel.w, panel.h = w, h
                 panel.x, panel.y = x+(w+4)*j, y+(h+4)*i
                 panel.r = 3 if int(w/panel.rn)<3 else int(w/panel.rn)
+                panel.history.resize(w/panel.r)
         pass
 
 
     def update(self, peers, dc):
         self.norm = 10 if self.norm*0.95<10 else self.norm*0.95
+        batch = DrawBatch(self.cache)
+        dc.SetFont(self.cache.font)
+        # The bars first, so that the text is drawn on top of them
+        for peer in peers.values():
+            self.panellist[peer["panel"]].draw_percentage_bar(peer, batch)
+        batch.flush(dc)
         for peer in peers.values():
             panel = self.panellist[peer["panel"]]
-            panel.update(peer, dc)
+            panel.update(peer, dc, batch)
+        batch.flush(dc)
         pass
 
 class MyFrame(wx.Frame):
@@ -221,8 +213,13 @@ class MyFrame(wx.Frame):
         pass
 
     def on_list_select(self, event=None):
+        self.peers_lock.acquire()
         self.filter = event.GetString()
+        FILTER.set([self.filter])
         self.peers = {}
+        for panel in self.info_panel.panellist:
+            panel.history.clear()
+        self.peers_lock.release()
         pass
 
     def start_experiment(self, event=None):
@@ -234,19 +231,20 @@ class MyFrame(wx.Frame):
 
     def process_multicast(self):
         while True:
-            try:
-                data = INCQUE.get()
+            for data in INCQUE.get():
                 self.peers_lock.acquire()
-                if data["node"] == self.filter:
-                    peer = data["peer"]
-                    if peer in self.peers.keys():
-                        data["panel"] = self.peers[peer]["panel"]
-                    else:
-                        data["panel"] = len(self.peers)
-                    self.peers[peer] = data
-                self.peers_lock.release()
-            except Exception, err:
-                print "Exception:process_multicast():", err
+                try:
+                    # Frames decoded before the listener saw the new filter
+                    if data["node"] == self.filter:
+                        peer = data["peer"]
+                        if peer in self.peers.keys():
+                            data["panel"] = self.peers[peer]["panel"]
+                        else:
+                            data["panel"] = len(self.peers)
+                        self.peers[peer] = data
+                        self.info_panel.panellist[data["panel"]].record(data)
+                except Exception, err:
+                    print "Exception:process_multicast():", err
                 self.peers_lock.release()
         pass
 
@@ -262,7 +260,7 @@ if __name__=="__main__":
     frame = MyFrame(None, "Liang, Experiment Monitor", (800, 600))
     frame.Show()
     # Start the multicast listener as daemon
-    listener = Process(target=MyListener(None,2121,False).listen_forever, args=())
+    listener = Process(target=MyListener(None,2121,False,filter=FILTER).listen_forever, args=())
     listener.daemon = True
     listener.start()
     # Start the worker thread for processing update multicasts
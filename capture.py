@@ -0,0 +1,179 @@
+#!/usr/bin/python
+#
+# Capture and replay of the datagrams arriving at MyListener, so that the
+# ingest, decode and paint paths can be benchmarked offline against real
+# traffic. A capture file holds timestamped raw datagrams, and a sidecar
+# .idx file maps a timestamp every INDEX_EVERY records to its file offset.
+# The node reports (1212) and the peer reports (2121) are recorded into the
+# same file by default, and several files are merged by timestamp on replay.
+#
+# Usage: capture.py record <file> [port ...]
+#        capture.py replay <file[,file...]> <host[:port]> [speed|max] [multiply] [from_ts]
+#
+# Without a port the datagrams are replayed to the ports they arrived at.
+#
+
+import os
+import sys
+import time
+import heapq
+import struct
+import socket
+import threading
+from wire import is_legacy, unpack_header, pack_header, frame_version
+from wire import unpack_batch, encode_batch, MSG_BATCH, FLAG_ZLIB
+
+CAP_MAGIC = "UMCAP\x01"
+CAP_RECORD = struct.Struct("!dH4sHH")   # ts, listener port, src ip, src port, len
+CAP_INDEX = struct.Struct("!dQ")        # ts, offset of the record
+INDEX_EVERY = 1024
+RECORD_PORTS = (1212, 2121)             # Node and peer reports
+
+class Recorder(object):
+    """Append the raw datagrams of one or more listeners to a capture file."""
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path)
+        self.f = open(path, "ab")
+        self.idx = open(path + ".idx", "ab")
+        if new:
+            self.f.write(CAP_MAGIC)
+        self.count = 0
+        self.lock = threading.Lock()
+        pass
+
+    def write(self, ts, port, addr, data):
+        self.lock.acquire()
+        try:
+            if self.count % INDEX_EVERY == 0:
+                self.idx.write(CAP_INDEX.pack(ts, self.f.tell()))
+            self.f.write(CAP_RECORD.pack(ts, port, socket.inet_aton(addr[0]), addr[1], len(data)))
+            self.f.write(data)
+            self.count += 1
+        finally:
+            self.lock.release()
+        pass
+
+    def flush(self):
+        self.lock.acquire()
+        self.f.flush()
+        self.idx.flush()
+        self.lock.release()
+        pass
+
+    def close(self):
+        self.f.close()
+        self.idx.close()
+        pass
+
+    pass
+
+def read_index(path):
+    if not os.path.exists(path + ".idx"):
+        return []
+    s = open(path + ".idx", "rb").read()
+    return [ CAP_INDEX.unpack_from(s, i) for i in range(0, len(s) - CAP_INDEX.size + 1, CAP_INDEX.size) ]
+
+def read_capture(path, from_ts=None):
+    """Yield (ts, port, (ip, port), data) of the records, starting at the
+    indexed position just before from_ts if it is given."""
+    f = open(path, "rb")
+    if f.read(len(CAP_MAGIC)) != CAP_MAGIC:
+        raise ValueError("%s is not a umon capture" % path)
+    if from_ts is not None:
+        offsets = [ off for ts, off in read_index(path) if ts <= from_ts ]
+        if offsets:
+            f.seek(offsets[-1])
+    while True:
+        head = f.read(CAP_RECORD.size)
+        if len(head) < CAP_RECORD.size:
+            break
+        ts, port, ip, sport, n = CAP_RECORD.unpack(head)
+        data = f.read(n)
+        if from_ts is not None and ts < from_ts:
+            continue
+        yield ts, port, (socket.inet_ntoa(ip), sport), data
+    f.close()
+
+def read_captures(paths, from_ts=None):
+    """The records of several captures merged in timestamp order."""
+    return heapq.merge(*[ read_capture(path, from_ts) for path in paths ])
+
+def rename_frame(data, suffix):
+    """The frame with suffix appended to the sender's name, and to the
+    names of the frames in a batch. Old pickle frames cannot be renamed and
+    are returned as they are."""
+    if is_legacy(data):
+        return data
+    mtype, flags, name, off = unpack_header(data)
+    if mtype == MSG_BATCH:
+        frames = [ rename_frame(f, suffix) for f in unpack_batch(data) ]
+        return encode_batch(name + suffix, frames, bool(flags & FLAG_ZLIB))
+    return pack_header(mtype, name + suffix, flags, frame_version(data)) + data[off:]
+
+class Replayer(object):
+    """Send one capture, or several merged, to the listeners on host. path
+    is a file name or a list of them. speed is a multiple of the
+    recorded pace, or 0 for as fast as possible. With multiply > 1 every
+    datagram is also sent as if from multiply-1 more nodes, named
+    <nodename>-1, <nodename>-2 and so on."""
+    def __init__(self, path, host, speed=1.0, multiply=1, port=None):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.multiply = multiply
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sent = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        pass
+
+    def run(self, from_ts=None):
+        t0, ts0 = time.time(), None
+        paths = [ self.path ] if isinstance(self.path, str) else self.path
+        for ts, port, addr, data in read_captures(paths, from_ts):
+            if ts0 is None:
+                ts0 = ts
+            if self.speed:
+                delay = (ts - ts0) / self.speed - (time.time() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+            for k in range(self.multiply):
+                frame = rename_frame(data, "-%i" % k) if k else data
+                self.sock.sendto(frame, (self.host, self.port or port))
+                self.sent += 1
+                self.bytes += len(frame)
+        self.elapsed = time.time() - t0
+        pass
+
+    pass
+
+if __name__=="__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "record":
+        from centermc import *
+        ports = [ int(p) for p in sys.argv[3:] ] or RECORD_PORTS
+        recorder = Recorder(sys.argv[2])
+        for port in ports:
+            listener = MyListener(MGROUP, port, MGROUP is None and port == 1212, recorder=recorder,
+                                  name="listener.%i" % port)
+            t = threading.Thread(target=listener.listen_forever, args=())
+            t.daemon = True
+            t.start()
+        # Nobody consumes the decoded messages while recording
+        while True:
+            INCQUE.get()
+    elif len(sys.argv) > 3 and sys.argv[1] == "replay":
+        speed = sys.argv[4] if len(sys.argv) > 4 else "1"
+        speed = 0 if speed == "max" else float(speed)
+        multiply = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        from_ts = float(sys.argv[6]) if len(sys.argv) > 6 else None
+        host, _, port = sys.argv[3].partition(":")
+        replayer = Replayer(sys.argv[2].split(","), host, speed, multiply, int(port) if port else None)
+        replayer.run(from_ts)
+        print "Sent %i datagrams, %i bytes in %.2fs, %.0f datagrams/s" % \
+              (replayer.sent, replayer.bytes, replayer.elapsed, replayer.sent / max(replayer.elapsed, 1e-6))
+    else:
+        print "Usage: capture.py record <file> [port ...]"
+        print "       capture.py replay <file[,file...]> <host[:port]> [speed|max] [multiply] [from_ts]"
+    sys.exit(0)
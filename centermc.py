@@ -9,65 +9,497 @@
 
 import time
 import os,sys
+import errno
+import select
 import struct
-import pickle
 import socket
 import threading
 import subprocess
-import SocketServer
+from Queue import Full, Queue as ThreadQueue
 from myutil import *
+from collector import ProcFile
+from wire import Decoder, encode_node, frame_name, is_legacy
+from registration import Registrar
+from latency import LinkTracker
+from statetab import StateTable
+from tsdb import Store
+from metrics import serve, gauge, histogram, timer
 from multiprocessing import *
 
-INCQUE = Queue(2**20)
+MGROUP = None                   # Multicast group the nodes publish to, if any
+RCVBUF = 4*2**20                # Receive buffer of the listener's socket
+BATCH = 256                     # Max num of datagrams drained at once
+PACKAGE_LEN = 16*2**10
+INCQUE = Queue(2**20)           # Decoded messages, a list per batch
+STATE = StateTable()            # Latest node reports, shared with the GUI
+DECODER = Decoder()
+AGGR_PORT = 1213                # TCP port of the aggregator's subscribers
+AGGR_PATH = "/tmp/umon-aggregator.sock"
+AGGR_INTERVAL = 0.2             # How often deltas are sent to the subscribers
+AGGR_BACKLOG = 4*2**20          # Bytes queued for a subscriber before it is dropped
+FILTER_LEN = 4096               # Bytes of sender names a NameFilter holds
 
-class MyUDPServer(SocketServer.UDPServer):
-    allow_reuse_address = True
-    pass
+FRAME_SNAPSHOT = 1
+FRAME_DELTA = 2
+STREAM_HEADER = struct.Struct("!BI")    # frame kind, len(body)
+STREAM_ENTRY = struct.Struct("!dH")     # recv_ts, len(wire frame)
 
-class MyRequestHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
-        try:
-            data = pickle.loads(self.request[0].strip())
-            #print "%s wrote:%s" % (self.client_address[0], data) # Remember to comment it out!!!
-            INCQUE.put(data, False)
-            socket = self.request[1]
-            #socket.sendto("OK", self.client_address)
-        except Exception, err:
-            print "Exception:CentralServer.handle():", err
+def is_multicast(ip):
+    """True if ip is an IPv4 multicast group, 224.0.0.0/4."""
+    try:
+        return 224 <= int(ip.split(".")[0]) <= 239
+    except ValueError:
+        return False
+
+class NameFilter(object):
+    """A subscription to the frames of some senders, set by one process and
+    applied by a listener in another. The names live in shared memory with
+    a generation counter, so the listener parses them again only after a
+    change. None subscribes to every sender. Old pickle frames have no
+    header, so they are filtered on their "node" or "nodename" once
+    decoded, still before they are queued to the GUI."""
+    def __init__(self, names=None, size=FILTER_LEN):
+        self.buf = Array("c", size)
+        self.generation = Value("L", 0)
+        self.seen = -1                   # Generation of self.names
+        self.names = None
+        self.dropped = 0
+        self.set(names)
+        pass
+
+    def set(self, names):
+        data = "*" if names is None else "=" + "\n".join(names)
+        if len(data) >= len(self.buf):
+            raise ValueError("filter of %i bytes, more than %i" % (len(data), len(self.buf)))
+        with self.buf.get_lock():
+            self.buf.value = data
+            self.generation.value += 1
+        pass
+
+    def refresh(self):
+        """Pick up the latest names, if they changed since the last call."""
+        if self.generation.value == self.seen:
+            return
+        with self.buf.get_lock():
+            self.seen = self.generation.value
+            data = self.buf.value
+        self.names = None if data == "*" else set(n for n in data[1:].split("\n") if n)
+        pass
+
+    def accepts(self, name):
+        """False for a named sender outside the subscription."""
+        if name is None or self.names is None or name in self.names:
+            return True
+        self.dropped += 1
+        return False
 
-    def handle_error(self, request, client_address):
-        print "Error:CentralServer.handle_error():", request
+    pass
 
 class MyListener(object):
-    def __init__(self, mgrp=None, mport=None, register=False):
+    """Receive the nodes' datagrams. The socket is drained in batches into
+    preallocated buffers, the whole batch is decoded at once and put into
+    INCQUE as one list. If a StateTable is given, node reports are written
+    into it instead, and the other messages are dropped and counted as
+    unqueued unless queue_rest says that something reads INCQUE too. A
+    capture.Recorder, if given, gets a copy of every raw datagram. With a
+    NameFilter only the frames of the subscribed senders are decoded. name
+    keys the listener's metrics, so that the listeners sharing a process
+    each have their own socket and gauges."""
+    def __init__(self, mgrp=None, mport=None, register=False, rcvbuf=RCVBUF, batch=BATCH, table=None, recorder=None, filter=None, queue_rest=False, name="listener"):
         #self.addr = (subprocess.Popen(["hostname","-I"], stdout=subprocess.PIPE).communicate()[0].split()[0], 1212)
         self.addr = (mgrp if mgrp else get_myip(), mport if mport else 1212)
-        self.server = MyUDPServer(self.addr, MyRequestHandler)
-        self.server.allow_reuse_address = True
-        self.sock = socket.fromfd(self.server.fileno(), socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self.regs = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        if register:
-            t = threading.Thread(target=self.register_me, args=())
-            t.daemon = True
-            t.start()
+        self.multicast = is_multicast(self.addr[0])
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if rcvbuf:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(("", self.addr[1]) if self.multicast else self.addr)
+        if self.multicast:
+            mreq = struct.pack("4s4s", socket.inet_aton(self.addr[0]), socket.inet_aton("0.0.0.0"))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.sock.setblocking(0)
+        self.name = name
+        self.table = table
+        self.queue_rest = queue_rest
+        self.unqueued = 0                # Messages with no table slot nor reader
+        self.recorder = recorder
+        self.filter = filter
+        self.buffers = [ bytearray(PACKAGE_LEN) for i in range(batch) ]
+        self.views = [ memoryview(b) for b in self.buffers ]
+        self.inode = os.fstat(self.sock.fileno()).st_ino
+        self.udpstat = ProcFile("/proc/net/udp", 2**16)
+        self.received = 0
+        self.batches = 0
+        self.decode_errors = 0
+        self.frames = 0                  # Messages decoded, more than received with relays
+        self.queue_drops = 0
+        self.kernel_drops = 0
+        self.registrar = Registrar(self.addr) if register else None
+        self.links = LinkTracker()
         pass
 
     def register_me(self):
-        while True:
-            for i in range(1, 256):
-                try:
-                    self.regs.sendto(pickle.dumps(self.addr, pickle.HIGHEST_PROTOCOL),
-                                     ("ukko%03i.hpc.cs.helsinki.fi" % i, self.addr[1]))
-                except Exception, err:
-                    print "Exception:centermc.py:MyListener.register_me():", err
-            time.sleep(300)
+        """Keep the registrations fresh, in the process receiving the acks."""
+        t = threading.Thread(target=self.registrar.run, args=())
+        t.daemon = True
+        t.start()
+        pass
+
+    def register_metrics(self):
+        """Serve the listener's own costs, see metrics.py."""
+        gauge(self.name, self.counters)
+        gauge(self.name + ".queue_depth", INCQUE.qsize)
+        gauge(self.name + ".links", self.links.summary)
+        if self.table is not None:
+            gauge(self.name + ".table", lambda: { "used": self.table.used(), "overflow": self.table.overflow })
+        try:
+            serve(self.name)
+        except Exception, err:
+            print "Exception:centermc.py:MyListener.register_metrics():", err
         pass
 
     def listen_forever(self):
-        self.server.serve_forever()
+        if self.registrar:
+            self.register_me()
+        self.register_metrics()
+        last_check = time.time()
+        while True:
+            try:
+                select.select([self.sock], [], [], 1.0)
+                batch = self.recv_batch()
+                if batch:
+                    with timer(self.name + ".decode"):
+                        msgs = self.decode_batch(batch)
+                    with timer(self.name + ".dispatch"):
+                        self.dispatch(msgs)
+                if time.time() - last_check >= 1:
+                    self.kernel_drops = self.get_kernel_drops()
+                    if self.recorder:
+                        self.recorder.flush()
+                    last_check = time.time()
+            except Exception, err:
+                print "Exception:centermc.py:MyListener.listen_forever():", err
+        pass
+
+    def recv_batch(self):
+        """Drain up to len(self.buffers) datagrams without blocking, and
+        return the datagrams as (buffer index, length, address)."""
+        batch = []
+        for i, buf in enumerate(self.buffers):
+            try:
+                n, addr = self.sock.recvfrom_into(buf)
+            except socket.error, err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            batch.append((i, n, addr))
+        if self.recorder:
+            ts = time.time()
+            for i, n, addr in batch:
+                self.recorder.write(ts, self.addr[1], addr, self.views[i][:n].tobytes())
+        self.received += len(batch)
+        if batch:
+            self.batches += 1
+        return batch
+
+    def decode_batch(self, batch):
+        """Decode the datagrams, stamping them with the batch's arrival."""
+        msgs = []
+        ts = time.time()
+        accept = None
+        if self.filter:
+            self.filter.refresh()
+            accept = self.filter.accepts
+        for i, n, addr in batch:
+            try:
+                legacy = is_legacy(self.views[i][:n])
+                if accept and not legacy and not accept(frame_name(self.views[i][:n])):
+                    continue
+                for msg in DECODER.decode_all(self.views[i][:n].tobytes(), accept):
+                    self.frames += 1
+                    if self.registrar:
+                        if msg.get("type") == "regack":
+                            self.registrar.confirm(addr[0], msg["addr"], ts)
+                            continue
+                        self.registrar.discover(addr[0])
+                    # Pickle frames have no header to filter on
+                    if legacy and accept and isinstance(msg, dict) and \
+                       not accept(msg.get("node", msg.get("nodename"))):
+                        continue
+                    msg["recv_ts"] = ts
+                    if "timestamp" in msg and "nodename" in msg:
+                        self.links.observe(msg)
+                    msgs.append(msg)
+            except Exception, err:
+                self.decode_errors += 1
+                print "Exception:centermc.py:MyListener.decode_batch():", addr, err
+        return msgs
+
+    def dispatch(self, msgs):
+        if self.table is not None:
+            rest = []
+            for msg in msgs:
+                if msg.get("type") == "node":
+                    try:
+                        self.table.write(msg, msg["recv_ts"])
+                    except Exception, err:
+                        self.decode_errors += 1
+                        print "Exception:centermc.py:MyListener.dispatch():", msg.get("nodename"), err
+                else:
+                    rest.append(msg)
+            msgs = rest
+            if msgs and not self.queue_rest:
+                self.unqueued += len(msgs)
+                msgs = []
+        if msgs:
+            try:
+                INCQUE.put(msgs, False)
+            except Full:
+                self.queue_drops += len(msgs)
+        pass
+
+    def get_kernel_drops(self):
+        """The datagrams the kernel dropped on this socket, the last column
+        of its line in /proc/net/udp."""
+        inode = str(self.inode)
+        for line in self.udpstat.read().splitlines()[1:]:
+            fields = line.split()
+            if len(fields) > 9 and fields[9] == inode:
+                return int(fields[-1])
+        return self.kernel_drops
+
+    def counters(self):
+        counters = { "received": self.received, "batches": self.batches, "frames": self.frames,
+                     "packet_reduction": self.frames / float(max(self.received, 1)),
+                     "decode_errors": self.decode_errors, "queue_drops": self.queue_drops,
+                     "unqueued": self.unqueued,
+                     "kernel_drops": self.kernel_drops, "lost": self.links.lost,
+                     "reordered": self.links.reordered }
+        if self.registrar:
+            counters["registration"] = self.registrar.counters()
+        if self.filter:
+            counters["filtered"] = self.filter.dropped
+        return counters
+
+def pack_stream_frame(kind, updates):
+    """A snapshot or delta frame of the aggregator's stream, made of the
+    full wire frames of the given node stats."""
+    entries = []
+    for stats in updates:
+        data = encode_node(stats)
+        entries.append(STREAM_ENTRY.pack(stats["recv_ts"], len(data)) + data)
+    body = "".join(entries)
+    return STREAM_HEADER.pack(kind, len(body)) + body
+
+def unpack_stream_frame(body, decoder):
+    msgs = []
+    off = 0
+    while off < len(body):
+        recv_ts, n = STREAM_ENTRY.unpack_from(body, off)
+        off += STREAM_ENTRY.size
+        stats = decoder.decode(body[off:off+n])
+        stats["recv_ts"] = recv_ts
+        msgs.append(stats)
+        off += n
+    return msgs
+
+class Subscriber(object):
+    """A viewer attached to the aggregator, with its own outgoing backlog."""
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.addr = addr
+        self.out = []
+        self.pending = 0
+        pass
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def push(self, data):
+        """Queue data, or return False if the subscriber is too slow."""
+        if self.pending + len(data) > AGGR_BACKLOG:
+            return False
+        self.out.append(data)
+        self.pending += len(data)
+        return True
+
+    def flush(self):
+        data = "".join(self.out)
+        n = self.sock.send(data)
+        self.out = [ data[n:] ] if n < len(data) else []
+        self.pending = len(data) - n
+        pass
+
+    def close(self):
+        self.sock.close()
+        pass
+
+    pass
+
+class Aggregator(object):
+    """Ingest the node traffic once, through a listener process writing the
+    state table, and fan the cluster state out to any number of viewers.
+    A new subscriber gets a full snapshot, then the deltas every
+    AGGR_INTERVAL. A subscriber whose backlog exceeds AGGR_BACKLOG is
+    dropped, and gets a fresh snapshot when it reconnects. If a tsdb Store
+    is given, every sample is also written to it."""
+    def __init__(self, listener, table=STATE, port=AGGR_PORT, path=AGGR_PATH, store=None):
+        self.listener = listener
+        self.table = table
+        self.store = store
+        self.last_flush = time.time()
+        self.versions = []
+        self.subscribers = []
+        self.servers = []
+        if port:
+            tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcp.bind(("", port))
+            tcp.listen(16)
+            self.servers.append(tcp)
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            local = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            local.bind(path)
+            local.listen(16)
+            self.servers.append(local)
+        self.dropped = 0
+        pass
+
+    def snapshot(self):
+        slots = [ self.table.read(slot) for slot in range(self.table.used()) ]
+        return pack_stream_frame(FRAME_SNAPSHOT, [ stats for seq, stats in slots if seq ])
+
+    def accept(self, server):
+        sock, addr = server.accept()
+        sub = Subscriber(sock, addr)
+        sub.push(self.snapshot())
+        self.subscribers.append(sub)
+        pass
+
+    def drop(self, sub):
+        if sub in self.subscribers:
+            self.subscribers.remove(sub)
+            sub.close()
+        pass
+
+    def publish(self):
+        with timer("aggregator.publish"):
+            self.publish_changes()
+        pass
+
+    def publish_changes(self):
+        updates = [ stats for slot, stats in self.table.changed(self.versions) ]
+        now = time.time()
+        for stats in updates:
+            histogram("aggregator.queue_latency").observe(now - stats.get("recv_ts", now))
+        if self.store:
+            self.archive(updates)
+        if not updates:
+            return
+        frame = pack_stream_frame(FRAME_DELTA, updates)
+        for sub in list(self.subscribers):
+            if not sub.push(frame):
+                self.dropped += 1
+                print "Aggregator: dropped slow subscriber", sub.addr
+                self.drop(sub)
+        pass
+
+    def archive(self, updates):
+        updates.sort(key=lambda stats: stats["recv_ts"])
+        for stats in updates:
+            self.store.append(stats)
+        if time.time() - self.last_flush > 60:
+            self.store.flush()
+            self.last_flush = time.time()
         pass
 
+    def serve_forever(self):
+        p = Process(target=self.listener.listen_forever, args=())
+        p.daemon = True
+        p.start()
+        self.table.changed(self.versions)
+        gauge("aggregator", lambda: { "subscribers": len(self.subscribers), "dropped": self.dropped })
+        try:
+            serve("aggregator")
+        except Exception, err:
+            print "Exception:centermc.py:Aggregator.serve_forever():", err
+        next_tick = time.time()
+        while True:
+            try:
+                timeout = max(next_tick - time.time(), 0)
+                writers = [ sub for sub in self.subscribers if sub.pending ]
+                r, w, _ = select.select(self.servers + self.subscribers, writers, [], timeout)
+                for x in r:
+                    if x in self.servers:
+                        self.accept(x)
+                    elif not x.sock.recv(4096):
+                        self.drop(x)
+                for sub in w:
+                    try:
+                        sub.flush()
+                    except socket.error:
+                        self.drop(sub)
+                if time.time() >= next_tick:
+                    self.publish()
+                    next_tick += AGGR_INTERVAL
+                    if next_tick < time.time():
+                        next_tick = time.time() + AGGR_INTERVAL
+            except Exception, err:
+                print "Exception:centermc.py:Aggregator.serve_forever():", err
+        pass
+
+    pass
+
+class AggregatorClient(object):
+    """Attach a viewer to an aggregator at "host:port" or a unix socket
+    path. Decoded node reports are put into self.queue as lists, the first
+    one being the snapshot. The client reconnects if the aggregator goes
+    away."""
+    def __init__(self, target):
+        self.target = target
+        self.queue = ThreadQueue()
+        pass
+
+    def connect(self):
+        if ":" in self.target:
+            host, port = self.target.rsplit(":", 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((host, int(port)))
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.target)
+        return sock
+
+    def recv_exactly(self, sock, n):
+        chunks = []
+        while n:
+            s = sock.recv(n)
+            if not s:
+                raise socket.error("aggregator closed the connection")
+            chunks.append(s)
+            n -= len(s)
+        return "".join(chunks)
+
+    def run(self):
+        while True:
+            try:
+                sock = self.connect()
+                decoder = Decoder()
+                while True:
+                    kind, n = STREAM_HEADER.unpack(self.recv_exactly(sock, STREAM_HEADER.size))
+                    self.queue.put(unpack_stream_frame(self.recv_exactly(sock, n), decoder))
+            except Exception, err:
+                print "Exception:centermc.py:AggregatorClient.run():", err
+            time.sleep(5)
+        pass
+
+    pass
+
 if __name__ == "__main__":
-    listener = MyListener()
-    listener.listen_forever()
+    # Run as the aggregator the viewers attach to with pygui.py <host:port|path>
+    aggregator = Aggregator(MyListener(MGROUP, 1212, MGROUP is None, table=STATE), store=Store())
+    aggregator.serve_forever()
     sys.exit(0)
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#
+# Fork-free collectors for the node's stats. Every collector reads the kernel
+# interfaces (/proc, /sys, statvfs, utmp) directly instead of forking uptime,
+# free, df and ifconfig. The file descriptors are kept open and re-read from
+# offset 0 on every sample, which is how procfs is meant to be polled.
+#
+
+import os
+import time
+import struct
+import multiprocessing
+from metrics import histogram
+
+UTMP_FILE = "/var/run/utmp"
+UTMP_RECORD_LEN = 384
+UTMP_USER_PROCESS = 7
+
+def human_bytes(n):
+    """Format a byte counter the way ifconfig prints it, e.g. 1.2 GiB."""
+    n = float(n)
+    for unit in ("b", "KiB", "MiB", "GiB", "TiB"):
+        if n < 1024.0 or unit == "TiB":
+            break
+        n /= 1024.0
+    return "%.1f %s" % (n, unit)
+
+class ProcFile(object):
+    """An open procfs/sysfs file which is re-read with seek-to-0."""
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.size = size
+        self.fd = os.open(path, os.O_RDONLY)
+        pass
+
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            s = os.read(self.fd, self.size)
+            if not s:
+                break
+            chunks.append(s)
+        return "".join(chunks)
+
+    def close(self):
+        os.close(self.fd)
+        pass
+
+    pass
+
+class Collector(object):
+    """Base class of the collectors. A collector fills in its keys of the
+    stats dict, and remembers how long the last collection took."""
+    name = "collector"
+
+    def __init__(self):
+        self.elapsed = 0.0
+        pass
+
+    def collect(self, stats):
+        t0 = time.time()
+        try:
+            self.sample(stats)
+        finally:
+            self.elapsed = time.time() - t0
+        pass
+
+    def sample(self, stats):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    pass
+
+class LoadCollector(Collector):
+    """1 min load average from /proc/loadavg."""
+    name = "load"
+
+    def __init__(self):
+        Collector.__init__(self)
+        self.f = ProcFile("/proc/loadavg")
+        self.cpu_count = multiprocessing.cpu_count()
+        pass
+
+    def sample(self, stats):
+        stats["load"] = float(self.f.read().split()[0])
+        stats["cpu_count"] = self.cpu_count
+        pass
+
+    def close(self):
+        self.f.close()
+        pass
+
+    pass
+
+class MemCollector(Collector):
+    """Total and used physical memory in MB from /proc/meminfo."""
+    name = "mem"
+
+    def __init__(self):
+        Collector.__init__(self)
+        self.f = ProcFile("/proc/meminfo")
+        pass
+
+    def sample(self, stats):
+        info = {}
+        for line in self.f.read().splitlines():
+            k, _, v = line.partition(":")
+            info[k] = int(v.split()[0])
+        total = info["MemTotal"]
+        if "MemAvailable" in info:
+            avail = info["MemAvailable"]
+        else:
+            avail = info["MemFree"] + info.get("Buffers", 0) + info.get("Cached", 0)
+        stats["mem_total"] = total / 1024
+        stats["mem_used"] = (total - avail) / 1024
+        pass
+
+    def close(self):
+        self.f.close()
+        pass
+
+    pass
+
+class DiskCollector(Collector):
+    """Disk usage of a mount point via statvfs, rounded up like df does."""
+    name = "disk"
+
+    def __init__(self, path="/"):
+        Collector.__init__(self)
+        self.path = path
+        pass
+
+    def sample(self, stats):
+        st = os.statvfs(self.path)
+        used = st.f_blocks - st.f_bfree
+        total = used + st.f_bavail
+        pct = (used * 100 + total - 1) / total if total else 0
+        stats["disk"] = "%i%%" % pct
+        stats["disk_pct"] = pct
+        pass
+
+    pass
+
+class UserCollector(Collector):
+    """Number of login sessions, i.e. the USER_PROCESS records in utmp.
+    Nodes without utmp simply report no users."""
+    name = "user"
+
+    def __init__(self, path=UTMP_FILE):
+        Collector.__init__(self)
+        self.f = ProcFile(path, 64 * UTMP_RECORD_LEN) if os.path.exists(path) else None
+        pass
+
+    def sample(self, stats):
+        s = self.f.read() if self.f else ""
+        count = 0
+        for i in range(0, len(s) - UTMP_RECORD_LEN + 1, UTMP_RECORD_LEN):
+            if struct.unpack_from("h", s, i)[0] == UTMP_USER_PROCESS:
+                count += 1
+        stats["user_count"] = count
+        pass
+
+    def close(self):
+        if self.f:
+            self.f.close()
+        pass
+
+    pass
+
+class NetCollector(Collector):
+    """Traffic counters and rates of one interface from /proc/net/dev."""
+    name = "net"
+
+    def __init__(self, eth):
+        Collector.__init__(self)
+        self.eth = eth
+        self.f = ProcFile("/proc/net/dev")
+        self.rx, self.tx = None, None
+        self.last_update = time.time()
+        pass
+
+    def counters(self):
+        for line in self.f.read().splitlines()[2:]:
+            name, _, fields = line.partition(":")
+            if name.strip() == self.eth:
+                fields = fields.split()
+                return int(fields[0]), int(fields[8])
+        raise KeyError(self.eth)
+
+    def sample(self, stats):
+        rx1, tx1 = self.counters()
+        t = time.time()
+        interval = max(t - self.last_update, 1e-3)
+        rx0 = self.rx if self.rx is not None else rx1
+        tx0 = self.tx if self.tx is not None else tx1
+        stats["rx"] = human_bytes(rx1)
+        stats["tx"] = human_bytes(tx1)
+        stats["rx_bytes"] = rx1
+        stats["tx_bytes"] = tx1
+        stats["rr"] = int((rx1 - rx0) / interval)
+        stats["tr"] = int((tx1 - tx0) / interval)
+        self.rx, self.tx = rx1, tx1
+        self.last_update = t
+        pass
+
+    def close(self):
+        self.f.close()
+        pass
+
+    pass
+
+class CollectorSet(object):
+    """A pluggable list of collectors sampled one after another. A failing
+    collector does not stop the others, and the time taken by each one is
+    kept in self.timings."""
+    def __init__(self, collectors=None):
+        self.collectors = list(collectors) if collectors else []
+        self.timings = {}
+        pass
+
+    def register(self, collector):
+        self.collectors.append(collector)
+        pass
+
+    def collect(self, stats):
+        for c in self.collectors:
+            try:
+                c.collect(stats)
+            except Exception, err:
+                print "Exception:collector.py:CollectorSet.collect():%s:" % c.name, err
+            self.timings[c.name] = c.elapsed
+            histogram("collect." + c.name).observe(c.elapsed)
+        return stats
+
+    def close(self):
+        for c in self.collectors:
+            c.close()
+        pass
+
+    pass
+
+def default_collectors(eth, path="/"):
+    """The collectors umon uses for a node."""
+    return CollectorSet([ LoadCollector(), MemCollector(), DiskCollector(path),
+                          UserCollector(), NetCollector(eth) ])
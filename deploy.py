@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# Deployment of the node monitor agents with a bounded pool of workers.
+# The hosts an agent could not be started on are remembered in a file
+# with an exponential backoff, so the periodic self-healing does not keep
+# sshing into every address of the subnet.
+#
+
+import os
+import json
+import time
+import signal
+import threading
+import subprocess
+from Queue import Queue
+
+DEPLOY_WORKERS = 8              # Concurrent deployments
+DEPLOY_TIMEOUT = 30             # Seconds before a deployment is killed
+BACKOFF_BASE = 300              # Seconds to wait after the first failure
+BACKOFF_MAX = 24*3600
+CACHE_PATH = os.path.expanduser("~/.umon/unreachable-%s.json" % os.uname()[1])
+
+def run_with_timeout(cmd, timeout):
+    """Run a shell command, killing it after timeout seconds. Return its
+    exit code, or None if it timed out."""
+    p = subprocess.Popen(cmd, shell=True, stdout=open(os.devnull, "w"),
+                         stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    deadline = time.time() + timeout
+    while p.poll() is None:
+        if time.time() > deadline:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            p.wait()
+            return None
+        time.sleep(0.1)
+    return p.returncode
+
+class ReachCache(object):
+    """{host: [failures, time of the next attempt]}, kept in a json file."""
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.hosts = {}
+        try:
+            self.hosts = json.load(open(path))
+        except (IOError, ValueError):
+            pass
+        pass
+
+    def ready(self, host, now):
+        entry = self.hosts.get(host)
+        return entry is None or entry[1] <= now
+
+    def failed(self, host, now):
+        failures = self.hosts.get(host, [0, 0])[0] + 1
+        self.hosts[host] = [failures, now + min(BACKOFF_BASE * 2**(failures-1), BACKOFF_MAX)]
+        pass
+
+    def succeeded(self, host):
+        self.hosts.pop(host, None)
+        pass
+
+    def save(self):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp = self.path + ".tmp"
+            json.dump(self.hosts, open(tmp, "w"))
+            os.rename(tmp, self.path)
+        except Exception, err:
+            print "Exception:deploy.py:ReachCache.save():", err
+        pass
+
+    pass
+
+class Deployer(object):
+    """Run command(host, timeout) for the hosts given to deploy() on a
+    fixed pool of worker threads. A nonzero or missing exit code puts the
+    host in backoff; hosts in backoff or already queued are skipped."""
+    def __init__(self, command, workers=DEPLOY_WORKERS, timeout=DEPLOY_TIMEOUT, cache=None):
+        self.command = command
+        self.timeout = timeout
+        self.cache = cache if cache is not None else ReachCache()
+        self.queue = Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.succeeded, self.failed, self.skipped = 0, 0, 0
+        for i in range(workers):
+            t = threading.Thread(target=self.work, args=())
+            t.daemon = True
+            t.start()
+        pass
+
+    def deploy(self, hosts):
+        """Queue the hosts not in backoff. Return the num queued."""
+        now = time.time()
+        queued = 0
+        self.lock.acquire()
+        for host in hosts:
+            if host in self.queued or not self.cache.ready(host, now):
+                self.skipped += 1
+            else:
+                self.queued.add(host)
+                self.queue.put(host)
+                queued += 1
+        self.lock.release()
+        return queued
+
+    def work(self):
+        while True:
+            host = self.queue.get()
+            try:
+                ret = self.command(host, self.timeout)
+            except Exception, err:
+                print "Exception:deploy.py:Deployer.work():", host, err
+                ret = None
+            self.lock.acquire()
+            self.queued.discard(host)
+            if ret == 0:
+                self.succeeded += 1
+                self.cache.succeeded(host)
+            else:
+                self.failed += 1
+                self.cache.failed(host, time.time())
+            if self.queue.empty():
+                self.cache.save()
+            self.lock.release()
+        pass
+
+    def counters(self):
+        return { "succeeded": self.succeeded, "failed": self.failed,
+                 "skipped": self.skipped, "pending": len(self.queued) }
+
+    pass
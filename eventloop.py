@@ -0,0 +1,145 @@
+#!/usr/bin/python
+#
+# A single-threaded select loop for the daemons. Datagram sockets are
+# drained by their handlers when readable, and periodic tasks run on a
+# fixed grid of deadlines: every tick is scheduled from the previous
+# deadline rather than from when the previous tick finished, so the
+# period does not drift with the time the tasks take. Ticks missed by a
+# whole period are skipped, not run in a burst. The blocking work, i.e.
+# ssh and other subprocesses, belongs to worker pools such as
+# deploy.Deployer.
+#
+
+import time
+import errno
+import heapq
+import socket
+import select
+from metrics import histogram
+
+READ_BATCH = 64                 # Datagrams read per socket and wakeup
+RECV_SIZE = 2**16
+
+class Task(object):
+    """A function called at deadline, and every interval after it if
+    interval is given. interval is a number or a callable returning one."""
+    def __init__(self, fn, deadline, interval=None):
+        self.fn = fn
+        self.deadline = deadline
+        self.interval = interval
+        self.cancelled = False
+        pass
+
+    def period(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+    def cancel(self):
+        self.cancelled = True
+        pass
+
+    pass
+
+class Loop(object):
+    def __init__(self):
+        self.readers = {}                # fd -> (sock, handler)
+        self.timers = []                 # heap of (deadline, num, task)
+        self.scheduled = 0
+        self.running = False
+        self.wakeups, self.datagrams, self.ticks = 0, 0, 0
+        self.skipped, self.errors, self.max_lag = 0, 0, 0.0
+        pass
+
+    def add_datagram(self, sock, handler):
+        """Call handler(data, addr) for every datagram arriving on sock."""
+        sock.setblocking(0)
+        self.readers[sock.fileno()] = (sock, handler)
+        pass
+
+    def remove(self, sock):
+        self.readers.pop(sock.fileno(), None)
+        pass
+
+    def call_later(self, delay, fn):
+        return self.schedule(Task(fn, time.time() + delay))
+
+    def call_every(self, interval, fn, delay=0):
+        """Call fn every interval seconds, the first time after delay."""
+        return self.schedule(Task(fn, time.time() + delay, interval))
+
+    def schedule(self, task):
+        self.scheduled += 1
+        heapq.heappush(self.timers, (task.deadline, self.scheduled, task))
+        return task
+
+    def call(self, fn, *args):
+        try:
+            return fn(*args)
+        except Exception, err:
+            self.errors += 1
+            print "Exception:eventloop.py:Loop.call():", getattr(fn, "__name__", fn), err
+        pass
+
+    def read(self, fd):
+        sock, handler = self.readers[fd]
+        for i in range(READ_BATCH):
+            try:
+                data, addr = sock.recvfrom(RECV_SIZE)
+            except socket.error, err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.errors += 1
+                    print "Exception:eventloop.py:Loop.read():", err
+                break
+            self.datagrams += 1
+            self.call(handler, data, addr)
+        pass
+
+    def run_timers(self, now):
+        lag = histogram("loop.lag")
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, task = heapq.heappop(self.timers)
+            if task.cancelled:
+                continue
+            lag.observe(now - deadline)
+            self.max_lag = max(self.max_lag, now - deadline)
+            self.ticks += 1
+            self.call(task.fn)
+            if task.interval is None:
+                continue
+            period = max(task.period(), 1e-3)
+            task.deadline = deadline + period
+            now = time.time()
+            if task.deadline <= now:
+                missed = int((now - task.deadline) // period) + 1
+                self.skipped += missed
+                task.deadline += missed * period
+            self.schedule(task)
+        pass
+
+    def run(self):
+        """Serve until stop() is called."""
+        self.running = True
+        while self.running:
+            timeout = max(self.timers[0][0] - time.time(), 0) if self.timers else None
+            try:
+                readable = select.select(self.readers.keys(), [], [], timeout)[0]
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.wakeups += 1
+            for fd in readable:
+                if fd in self.readers:
+                    self.read(fd)
+            self.run_timers(time.time())
+        pass
+
+    def stop(self):
+        self.running = False
+        pass
+
+    def counters(self):
+        return { "wakeups": self.wakeups, "datagrams": self.datagrams, "ticks": self.ticks,
+                 "skipped": self.skipped, "errors": self.errors, "max_lag": self.max_lag,
+                 "timers": len(self.timers), "readers": len(self.readers) }
+
+    pass
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+#
+# SWIM-style gossip membership of the node monitors on a subnet, used by
+# nodemc instead of every node broadcasting "live" to every other node.
+# Each period a member pings one other member, picked round-robin. If no
+# ack arrives by the next period, FANOUT other members are asked to ping
+# it, and if there is still no ack by the period after that it becomes a
+# suspect. Suspects which do not refute the suspicion in time are declared
+# dead. Membership changes are piggybacked on the probes, so the traffic
+# per node stays constant as the cluster grows.
+#
+# Usage: gossip.py [nodes [loss [periods]]]
+#        simulates a cluster in-process and prints the convergence times
+#        and the traffic per node as JSON.
+#
+
+import sys
+import json
+import math
+import time
+import random
+import socket
+import struct
+import threading
+
+GOSSIP_MAGIC = "UG"
+MSG_HEADER = struct.Struct("!2sBIHIH")  # magic, type, seq, sender id, incarnation, num updates
+MSG_TARGET = struct.Struct("!4s")       # ping-req target
+MSG_UPDATE = struct.Struct("!4sHIB")    # ip, id, incarnation, state
+
+PING, ACK, PING_REQ, JOIN, SYNC = 1, 2, 3, 4, 5
+ALIVE, SUSPECT, DEAD = 0, 1, 2          # At equal incarnations the later state wins
+
+FANOUT = 3                      # Members asked to probe indirectly, and to answer a join
+MAX_PIGGYBACK = 32              # Updates carried by one message
+RETRANSMIT = 3                  # Every update is piggybacked RETRANSMIT*log2(N) times
+SUSPECT_PERIODS = 3             # Suspects are dead after SUSPECT_PERIODS*log2(N) periods
+DEAD_KEEP = 60                  # Seconds the dead members are remembered
+JOIN_INTERVAL = 10              # Seconds between joins while no member is known
+MAX_SYNC = 4000                 # Members sent in reply to a join
+
+def is_gossip(data):
+    return data[:len(GOSSIP_MAGIC)] == GOSSIP_MAGIC
+
+class Member(object):
+    __slots__ = ("ip", "id", "incarnation", "state", "since", "heard")
+
+    def __init__(self, ip, id, incarnation, state, now):
+        self.ip, self.id = ip, id
+        self.incarnation = incarnation
+        self.state = state
+        self.since = now                 # When the state last changed
+        self.heard = now                 # When a message was last received from it
+        pass
+
+    pass
+
+class Membership(object):
+    """The members known to this node. send(data, ip) transmits a message
+    to a member, or to everyone if ip is "<broadcast>". receive() is fed
+    the messages arriving at the node, and tick() is called once a period.
+    It is safe to call them from different threads."""
+    def __init__(self, id, ip, send, period=1.0):
+        self.id, self.ip = id, ip
+        self.send = send
+        self.period = period
+        self.incarnation = 0
+        self.members = {}                # ip -> Member, self not included
+        self.updates = {}                # ip -> [times piggybacked, update]
+        self.pending = {}                # seq -> [target, periods waited, requester, requester's seq]
+        self.targets = []                # Shuffled members still to probe this round
+        self.seq = 0
+        self.last_join = None
+        self.dead = []                   # Declared dead since the last take_dead()
+        self.lock = threading.Lock()
+        self.sent_bytes, self.sent_packets = 0, 0
+        self.recv_bytes, self.recv_packets = 0, 0
+        self.last_counted = time.time()
+        pass
+
+    def live(self):
+        return [ m for m in self.members.values() if m.state != DEAD ]
+
+    def log_n(self):
+        return math.ceil(math.log(len(self.members) + 2, 2))
+
+    def transmit(self, mtype, ip, seq=0, body="", updates=None):
+        if updates is None:
+            updates = self.piggyback()
+        data = MSG_HEADER.pack(GOSSIP_MAGIC, mtype, seq, self.id, self.incarnation, len(updates)) + \
+               body + "".join(MSG_UPDATE.pack(socket.inet_aton(u[0]), *u[1:]) for u in updates)
+        self.sent_bytes += len(data)
+        self.sent_packets += 1
+        try:
+            self.send(data, ip)
+        except Exception, err:
+            print "Exception:gossip.py:Membership.transmit():", ip, err
+        pass
+
+    def piggyback(self):
+        """The least disseminated updates, retired once they have been
+        piggybacked RETRANSMIT*log2(N) times."""
+        if not self.updates:
+            return []
+        limit = RETRANSMIT * self.log_n()
+        picked = sorted(self.updates.values())[:MAX_PIGGYBACK]
+        for entry in picked:
+            entry[0] += 1
+            if entry[0] >= limit:
+                self.updates.pop(entry[1][0], None)
+        return [ update for _, update in picked ]
+
+    def merge(self, ip, id, incarnation, state, now):
+        """Apply an update; a higher incarnation always wins, and at the
+        same incarnation alive < suspect < dead."""
+        if ip == self.ip:
+            if state != ALIVE and incarnation >= self.incarnation:
+                # Refute the suspicion about ourselves
+                self.incarnation = incarnation + 1
+                self.updates[ip] = [0, (ip, self.id, self.incarnation, ALIVE)]
+            return
+        m = self.members.get(ip)
+        if m is None:
+            if state == DEAD:
+                return
+            m = self.members[ip] = Member(ip, id, incarnation, state, now)
+        elif incarnation > m.incarnation or (incarnation == m.incarnation and state > m.state):
+            m.id, m.incarnation, m.state, m.since = id, incarnation, state, now
+        else:
+            return
+        if state == DEAD:
+            self.dead.append(ip)
+        self.updates[ip] = [0, (ip, id, incarnation, state)]
+        pass
+
+    def receive(self, data, addr, now=None):
+        now = now or time.time()
+        self.lock.acquire()
+        try:
+            self.recv_bytes += len(data)
+            self.recv_packets += 1
+            sender = addr[0]
+            if sender == self.ip:
+                return
+            magic, mtype, seq, id, incarnation, n = MSG_HEADER.unpack_from(data)
+            off = MSG_HEADER.size
+            target = None
+            if mtype == PING_REQ:
+                target = socket.inet_ntoa(MSG_TARGET.unpack_from(data, off)[0])
+                off += MSG_TARGET.size
+            self.merge(sender, id, incarnation, ALIVE, now)
+            m = self.members.get(sender)
+            if m:
+                m.heard = now
+                if m.state != ALIVE:
+                    # Tell it, so that it refutes with a higher incarnation
+                    self.updates[sender] = [0, (sender, m.id, m.incarnation, m.state)]
+            for i in range(n):
+                ip, uid, uinc, ustate = MSG_UPDATE.unpack_from(data, off + i*MSG_UPDATE.size)
+                self.merge(socket.inet_ntoa(ip), uid, uinc, ustate, now)
+            if mtype == PING:
+                self.transmit(ACK, sender, seq)
+            elif mtype == ACK:
+                p = self.pending.pop(seq, None)
+                if p and p[2]:
+                    self.transmit(ACK, p[2], p[3])
+            elif mtype == PING_REQ:
+                self.seq += 1
+                self.pending[self.seq] = [target, 0, sender, seq]
+                self.transmit(PING, target, self.seq)
+            elif mtype == JOIN:
+                if random.random() < FANOUT / float(max(len(self.members), FANOUT)):
+                    members = [ (m.ip, m.id, m.incarnation, m.state) for m in self.live() ]
+                    members.append((self.ip, self.id, self.incarnation, ALIVE))
+                    self.transmit(SYNC, sender, updates=members[:MAX_SYNC])
+        except Exception, err:
+            print "Exception:gossip.py:Membership.receive():", err
+        finally:
+            self.lock.release()
+        pass
+
+    def tick(self, now=None):
+        """Run one protocol period."""
+        now = now or time.time()
+        self.lock.acquire()
+        try:
+            live = self.live()
+            if not live and (self.last_join is None or now - self.last_join >= JOIN_INTERVAL):
+                self.last_join = now
+                self.transmit(JOIN, "<broadcast>")
+            for seq, p in self.pending.items():
+                target, waited, requester, _ = p
+                p[1] += 1
+                if requester or waited >= 1:
+                    self.pending.pop(seq)
+                    m = self.members.get(target)
+                    if not requester and m and m.state == ALIVE:
+                        self.merge(target, m.id, m.incarnation, SUSPECT, now)
+                else:
+                    helpers = [ m.ip for m in live if m.ip != target ]
+                    for ip in random.sample(helpers, min(FANOUT, len(helpers))):
+                        self.transmit(PING_REQ, ip, seq, MSG_TARGET.pack(socket.inet_aton(target)))
+            timeout = SUSPECT_PERIODS * self.log_n() * self.period
+            for m in self.members.values():
+                if m.state == SUSPECT and now - m.since > timeout:
+                    self.merge(m.ip, m.id, m.incarnation, DEAD, now)
+                elif m.state == DEAD and now - m.since > DEAD_KEEP:
+                    self.members.pop(m.ip)
+            while self.targets:
+                m = self.members.get(self.targets.pop())
+                if m and m.state != DEAD:
+                    self.seq += 1
+                    self.pending[self.seq] = [m.ip, 0, None, 0]
+                    self.transmit(PING, m.ip, self.seq)
+                    break
+            if not self.targets:
+                self.targets = [ m.ip for m in self.live() ]
+                random.shuffle(self.targets)
+        except Exception, err:
+            print "Exception:gossip.py:Membership.tick():", err
+        finally:
+            self.lock.release()
+        pass
+
+    def agents(self):
+        """{id: (ip, last heard)} of the members not known to be dead,
+        including this node."""
+        agents = dict((m.id, (m.ip, m.heard)) for m in self.live())
+        agents[self.id] = (self.ip, time.time())
+        return agents
+
+    def boss(self):
+        """The ip of the alive member with the highest (id, ip). Every
+        member with the same view agrees on it."""
+        alive = [ (m.id, m.ip) for m in self.members.values() if m.state == ALIVE ]
+        return max(alive + [ (self.id, self.ip) ])[1]
+
+    def take_dead(self):
+        dead, self.dead = self.dead, []
+        return dead
+
+    def counters(self):
+        """Traffic per second since the last call, and the num of members
+        in every state."""
+        t = time.time()
+        dt = max(t - self.last_counted, 1e-6)
+        states = [ m.state for m in self.members.values() ]
+        counters = { "sent_bytes": self.sent_bytes / dt, "sent_packets": self.sent_packets / dt,
+                     "recv_bytes": self.recv_bytes / dt, "recv_packets": self.recv_packets / dt,
+                     "alive": states.count(ALIVE) + 1, "suspect": states.count(SUSPECT),
+                     "dead": states.count(DEAD) }
+        self.sent_bytes, self.sent_packets = 0, 0
+        self.recv_bytes, self.recv_packets = 0, 0
+        self.last_counted = t
+        return counters
+
+    pass
+
+def simulate(nodes=240, loss=0.01, periods=120):
+    """Run a cluster of members over a lossy in-process network. Nodes
+    join during the first 10 periods; once they all know each other one
+    node is killed. Return the periods to converge and to detect the
+    failure, and the traffic per node."""
+    ips = [ "10.0.%i.%i" % (i / 250, i % 250 + 1) for i in range(nodes) ]
+    queue = []
+    def sender(src):
+        def send(data, ip):
+            queue.append((src, ip, data))
+        return send
+    members = dict((ip, Membership(i, ip, sender(ip))) for i, ip in enumerate(ips))
+    start = dict((ip, random.randint(0, 9)) for ip in ips)
+    killed, converged, detected = None, None, None
+    for period in range(periods):
+        for ip in ips:
+            if start[ip] <= period and ip != killed:
+                members[ip].tick(float(period))
+        while queue:
+            src, dst, data = queue.pop()
+            for ip in (ips if dst == "<broadcast>" else [dst]):
+                if ip != src and ip != killed and start[ip] <= period and random.random() >= loss:
+                    members[ip].receive(data, (src, 0), float(period))
+        others = [ members[ip] for ip in ips if ip != killed ]
+        if converged is None and period >= 9 and \
+           all(len(m.members) == nodes - 1 and len(m.live()) == nodes - 1 for m in others):
+            converged = period
+            killed = random.choice(ips)
+        elif killed and detected is None and \
+             all(members[killed].ip in m.members and m.members[killed].state == DEAD for m in others):
+            detected = period - converged
+            break
+    elapsed = float(period + 1)
+    sent = sum(m.sent_bytes for m in members.values())
+    packets = sum(m.sent_packets for m in members.values())
+    received = sum(m.recv_packets for m in members.values())
+    bosses = set(members[ip].boss() for ip in ips if ip != killed)
+    return { "nodes": nodes, "loss": loss, "periods": period + 1,
+             "join_converged_period": converged,
+             "failure_detected_periods": detected,
+             "bosses": len(bosses),
+             "sent_bytes_per_node_s": sent / nodes / elapsed,
+             "sent_packets_per_node_s": packets / nodes / elapsed,
+             "recv_packets_per_node_s": received / nodes / elapsed,
+             "alltoall_recv_packets_per_node_s": nodes - 1 }
+
+if __name__=="__main__":
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 240
+    loss = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    periods = int(sys.argv[3]) if len(sys.argv) > 3 else 120
+    print json.dumps(simulate(nodes, loss, periods), indent=2, sort_keys=True)
+    sys.exit(0)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Fixed-size history of a metric for the speed curves of pygui and btexp.
+# Samples go into a preallocated circular array in O(1), and the max over
+# the window is kept up to date with a monotonic deque instead of scanning
+# the whole history on every paint.
+#
+
+import numpy
+from collections import deque
+
+class History(object):
+    """Circular history of the last `size` samples of one series."""
+    def __init__(self, size=30):
+        self.size = max(int(size), 1)
+        self.data = numpy.zeros(self.size)
+        self.count = 0                   # Num of samples ever appended
+        self.maxq = deque()              # (index, value), values decreasing
+        pass
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, value):
+        i = self.count
+        self.data[i % self.size] = value
+        self.count += 1
+        maxq = self.maxq
+        while maxq and maxq[-1][1] <= value:
+            maxq.pop()
+        maxq.append((i, value))
+        while maxq[0][0] <= i - self.size:
+            maxq.popleft()
+        pass
+
+    def max(self):
+        """The largest sample in the window, 0 for an empty history."""
+        return self.maxq[0][1] if self.maxq else 0
+
+    def values(self):
+        """The samples in the window, oldest first."""
+        n = len(self)
+        i = self.count % self.size
+        if n < self.size:
+            return self.data[:n]
+        return numpy.concatenate((self.data[i:], self.data[:i]))
+
+    def resize(self, size):
+        """Change the window, keeping the latest samples."""
+        size = max(int(size), 1)
+        if size == self.size:
+            return
+        values = self.values()[-size:]
+        self.__init__(size)
+        for v in values:
+            self.append(v)
+        pass
+
+    def clear(self):
+        self.__init__(self.size)
+        pass
+
+    pass
+
+class SpeedHistory(object):
+    """The recv/send (or upload/download) pair behind a speed curve."""
+    def __init__(self, size=30):
+        self.a = History(size)
+        self.b = History(size)
+        pass
+
+    def record(self, a, b):
+        self.a.append(a)
+        self.b.append(b)
+        pass
+
+    def norm(self):
+        return max(self.a.max(), self.b.max())
+
+    def resize(self, size):
+        self.a.resize(size)
+        self.b.resize(size)
+        pass
+
+    def clear(self):
+        self.a.clear()
+        self.b.clear()
+        pass
+
+    pass
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+# The ingest stage between the listener and the GUI. Everything pending is
+# drained at once, only the newest report of every node is kept, and the
+# whole batch is applied under a single acquisition of the GUI's lock.
+#
+
+import re
+import time
+from Queue import Empty
+from metrics import histogram
+
+RATE_WINDOW = 10.0              # Seconds between the snapshots the rates are taken from
+
+class Ingest(object):
+    """Coalesce the pending node reports from a StateTable and/or a queue
+    of message lists. Nodenames are resolved to slots by a registry with a
+    slot(name) method if one is given. Otherwise names is the precomputed
+    nodename -> slot index, and other names are resolved from their digits
+    once and then cached."""
+    def __init__(self, table=None, queue=None, names=None, registry=None):
+        self.table = table
+        self.queue = queue
+        self.registry = registry
+        self.versions = []
+        self.index = dict(names) if names else {}
+        self.applied = 0
+        self.coalesced = 0
+        self.window = (time.time(), 0, 0)          # Snapshots of (time, applied, coalesced)
+        self.last_window = self.window
+        pass
+
+    def resolve(self, name):
+        if self.registry is not None:
+            return self.registry.slot(name)
+        slot = self.index.get(name)
+        if slot is None:
+            m = re.search(r"(\d+)", name)
+            slot = int(m.group(1)) - 1 if m else -1
+            self.index[name] = slot
+        return slot
+
+    def drain(self):
+        """Return {nodename: newest stats} of everything pending."""
+        latest = {}
+        if self.table is not None:
+            seen = list(self.versions)
+            for slot, data in self.table.changed(self.versions):
+                seq0 = seen[slot] if slot < len(seen) else 0
+                self.coalesced += max((self.versions[slot] - seq0) / 2 - 1, 0)
+                latest[data["nodename"]] = data
+        if self.queue is not None:
+            while True:
+                try:
+                    batch = self.queue.get_nowait()
+                except Empty:
+                    break
+                for data in batch:
+                    if data.get("type") != "node":
+                        continue
+                    if data["nodename"] in latest:
+                        self.coalesced += 1
+                    latest[data["nodename"]] = data
+        return latest
+
+    def run_once(self, lock, apply):
+        """Drain and apply(slot, stats) the newest reports under lock.
+        Return the num of reports applied."""
+        latest = self.drain()
+        if not latest:
+            return 0
+        applied = 0
+        now = time.time()
+        queue_latency = histogram("ingest.queue_latency")
+        lock.acquire()
+        try:
+            for name, data in latest.iteritems():
+                queue_latency.observe(now - data.get("recv_ts", now))
+                slot = self.resolve(name)
+                if slot < 0:
+                    continue
+                try:
+                    apply(slot, data)
+                    applied += 1
+                except Exception, err:
+                    print "Exception:ingest.py:Ingest.run_once():", name, err
+        finally:
+            lock.release()
+        self.applied += applied
+        if now - self.window[0] >= RATE_WINDOW:
+            self.last_window, self.window = self.window, (now, self.applied, self.coalesced)
+        return applied
+
+    def rates(self):
+        """Reports applied and coalesced per second over the last one to
+        two RATE_WINDOWs. The snapshots are taken as reports are applied,
+        so reading the rates changes nothing."""
+        t0, applied0, coalesced0 = self.last_window
+        dt = max(time.time() - t0, 1e-6)
+        return (self.applied - applied0) / dt, (self.coalesced - coalesced0) / dt
+
+    def counters(self):
+        applied, coalesced = self.rates()
+        return { "applied": self.applied, "coalesced": self.coalesced,
+                 "applied_per_s": applied, "coalesced_per_s": coalesced }
+
+    pass
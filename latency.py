@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Loss, reordering and latency accounting of the node reports at the
+# listener. Loss and reordering come from the per-node sequence numbers of
+# wire version 2. The one-way delay recv_ts - timestamp is the sum of the
+# clock offset between the node and the center and the latency, so the
+# offset is estimated as the minimum delay seen over the last
+# OFFSET_BUCKETS*OFFSET_BUCKET seconds, and what exceeds it is reported as
+# the network and queueing latency of the report.
+#
+
+from array import array
+from metrics import histogram
+
+SEQ_REORDER = 64                # A seq further behind than this means the sender restarted
+LATENCY_SAMPLES = 256           # Latencies kept per node
+OFFSET_BUCKET = 60              # Seconds per bucket of the minimum filter
+OFFSET_BUCKETS = 5
+TOP = 10                        # Worst nodes listed in the summary
+
+def percentiles(values, ps=(50, 95, 99)):
+    values = sorted(values)
+    if not values:
+        return dict(("p%i" % p, 0.0) for p in ps)
+    return dict(("p%i" % p, values[min(int(p/100.0*len(values)), len(values)-1)]) for p in ps)
+
+class Link(object):
+    """The reports of one node."""
+    __slots__ = ("last_seq", "last_ts", "received", "lost", "reordered", "duplicates", "restarts",
+                 "mins", "offset", "latencies", "count")
+
+    def __init__(self):
+        self.last_seq = None
+        self.last_ts = None              # Sender's timestamp of the report of last_seq
+        self.received, self.lost, self.reordered = 0, 0, 0
+        self.duplicates, self.restarts = 0, 0
+        self.mins = []                   # [bucket, min delay] of the recent buckets
+        self.offset = 0.0
+        self.latencies = array("d", [0.0] * LATENCY_SAMPLES)
+        self.count = 0
+        pass
+
+    def observe_seq(self, seq, ts=None):
+        """Return the change in the num of lost reports. A seq going back
+        is a restart of the sender if it goes back further than SEQ_REORDER,
+        or if the report is newer than the one of last_seq by the sender's
+        timestamp ts, as a late report is older."""
+        last = self.last_seq
+        if last is None or seq > last:
+            self.last_seq, self.last_ts = seq, ts
+            return seq - last - 1 if last is not None else 0
+        if last - seq > SEQ_REORDER or \
+           (seq < last and ts is not None and self.last_ts is not None and ts > self.last_ts):
+            self.restarts += 1
+            self.last_seq, self.last_ts = seq, ts
+        elif seq == last:
+            self.duplicates += 1
+        elif self.lost > 0:
+            # A report counted as lost arrived late
+            self.reordered += 1
+            return -1
+        return 0
+
+    def observe_delay(self, delay, recv_ts):
+        """Update the offset estimate and return the latency of the report."""
+        bucket = int(recv_ts // OFFSET_BUCKET)
+        if self.mins and self.mins[-1][0] == bucket:
+            self.mins[-1][1] = min(self.mins[-1][1], delay)
+        else:
+            self.mins.append([bucket, delay])
+            del self.mins[:-OFFSET_BUCKETS]
+        self.offset = min(m for _, m in self.mins)
+        latency = delay - self.offset
+        self.latencies[self.count % LATENCY_SAMPLES] = latency
+        self.count += 1
+        return latency
+
+    def summary(self):
+        s = { "received": self.received, "lost": self.lost, "reordered": self.reordered,
+              "duplicates": self.duplicates, "restarts": self.restarts,
+              "loss": self.lost / float(max(self.received + self.lost, 1)),
+              "offset": self.offset }
+        s.update(("latency_" + k, v) for k, v in
+                 percentiles(self.latencies[:min(self.count, LATENCY_SAMPLES)]).items())
+        return s
+
+    pass
+
+class LinkTracker(object):
+    """The links of all the nodes heard by a listener."""
+    def __init__(self):
+        self.links = {}
+        self.received, self.lost, self.reordered = 0, 0, 0
+        pass
+
+    def observe(self, msg):
+        """Account for a decoded node or heartbeat report."""
+        link = self.links.get(msg["nodename"])
+        if link is None:
+            link = self.links[msg["nodename"]] = Link()
+        link.received += 1
+        self.received += 1
+        seq = msg.get("seq")
+        if seq is not None:
+            lost = link.observe_seq(seq, msg["timestamp"])
+            link.lost += lost
+            self.lost += lost
+            if lost < 0:
+                self.reordered += 1
+        latency = link.observe_delay(msg["recv_ts"] - msg["timestamp"], msg["recv_ts"])
+        histogram("listener.latency").observe(latency)
+        pass
+
+    def link(self, name):
+        link = self.links.get(name)
+        return link.summary() if link else None
+
+    def summary(self, top=TOP):
+        """Totals, and the nodes with the most loss and the highest p95."""
+        links = [ (name, link.summary()) for name, link in self.links.items() ]
+        return { "nodes": len(links), "received": self.received, "lost": self.lost,
+                 "reordered": self.reordered,
+                 "loss": self.lost / float(max(self.received + self.lost, 1)),
+                 "worst_loss": dict(sorted(links, key=lambda x: -x[1]["loss"])[:top]),
+                 "worst_latency": dict(sorted(links, key=lambda x: -x[1]["latency_p95"])[:top]) }
+
+    pass
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+#
+# Self-instrumentation of umon. Every process keeps its own registry of
+# counters, latency histograms and gauges (callables returning a number or
+# a dict, e.g. the counters() of a component), and serves a JSON snapshot
+# of them on a unix socket, /tmp/umon-metrics-<uid>-<component>-<pid>.sock,
+# so that several processes of the same component and other users' umon
+# processes do not collide. A sampling profiler can be switched on through
+# the same socket.
+#
+# Usage: metrics.py <component>[:pid] [metrics|profile on|profile off|profile]
+#        prints the snapshot, toggles the profiler or prints its stacks, of
+#        every running process of the component unless a pid is given.
+#
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import errno
+import socket
+import threading
+import traceback
+
+METRICS_PATH = "/tmp/umon-metrics-%i-%s-%s.sock"   # uid, component, pid
+PROFILE = False                 # Start the sampling profiler with the process
+PROFILE_INTERVAL = 0.01         # Seconds between stack samples
+PROFILE_TOP = 50                # Stacks reported
+
+# Upper bounds of the histogram buckets in seconds, 1us to ~17s
+BUCKETS = [ 1e-6 * 2**i for i in range(25) ]
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        pass
+
+    def inc(self, n=1):
+        self.value += n
+        pass
+
+    pass
+
+class Histogram(object):
+    """Latencies in power-of-two buckets; percentiles are bucket bounds."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        pass
+
+    def observe(self, v, n=1):
+        i = 0
+        while i < len(BUCKETS) and v > BUCKETS[i]:
+            i += 1
+        self.counts[i] += n
+        self.count += n
+        self.sum += v * n
+        self.max = max(self.max, v)
+        pass
+
+    def percentile(self, p):
+        rank, seen = p / 100.0 * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        return { "count": self.count, "sum": self.sum, "max": self.max,
+                 "mean": self.sum / self.count if self.count else 0.0,
+                 "p50": self.percentile(50), "p95": self.percentile(95),
+                 "p99": self.percentile(99) }
+
+    pass
+
+class Timer(object):
+    """with timer(name): ... observes the time taken by the block."""
+    def __init__(self, histogram):
+        self.histogram = histogram
+        pass
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.t0)
+        return False
+
+    pass
+
+class Profiler(threading.Thread):
+    """Statistical profiler sampling the stacks of all the other threads."""
+    def __init__(self, interval=PROFILE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}                 # "file:func:line;..." -> samples
+        self.samples = 0
+        self.running = threading.Event()
+        pass
+
+    def run(self):
+        me = threading.current_thread().ident
+        while True:
+            self.running.wait()
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = ";".join("%s:%s:%i" % (os.path.basename(f), fn, line)
+                                 for f, line, fn, _ in traceback.extract_stack(frame))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        pass
+
+    def enable(self, on):
+        if on:
+            self.running.set()
+        else:
+            self.running.clear()
+        pass
+
+    def top(self, n=PROFILE_TOP):
+        stacks = sorted(self.stacks.items(), key=lambda x: -x[1])[:n]
+        return { "samples": self.samples, "enabled": self.running.isSet(),
+                 "stacks": [ { "stack": s, "count": c } for s, c in stacks ] }
+
+    pass
+
+class Registry(object):
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.profiler = None
+        self.lock = threading.Lock()
+        pass
+
+    def get(self, table, name, cls):
+        m = table.get(name)
+        if m is None:
+            self.lock.acquire()
+            m = table.setdefault(name, cls())
+            self.lock.release()
+        return m
+
+    def snapshot(self):
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception, err:
+                gauges[name] = "error: %s" % err
+        return { "pid": os.getpid(), "uptime": time.time() - self.started,
+                 "counters": dict((k, c.value) for k, c in self.counters.items()),
+                 "histograms": dict((k, h.snapshot()) for k, h in self.histograms.items()),
+                 "gauges": gauges,
+                 "profiling": bool(self.profiler and self.profiler.running.isSet()) }
+
+    def profile(self, on):
+        if self.profiler is None:
+            self.profiler = Profiler()
+            self.profiler.start()
+        self.profiler.enable(on)
+        pass
+
+    def handle(self, cmd):
+        """Answer a command received on the metrics socket."""
+        cmd = cmd.strip()
+        if cmd in ("profile on", "profile off"):
+            self.profile(cmd == "profile on")
+            return { "profiling": cmd == "profile on" }
+        if cmd == "profile":
+            return self.profiler.top() if self.profiler else { "samples": 0, "stacks": [] }
+        return self.snapshot()
+
+    pass
+
+REGISTRY = Registry()
+
+def counter(name):
+    return REGISTRY.get(REGISTRY.counters, name, Counter)
+
+def histogram(name):
+    return REGISTRY.get(REGISTRY.histograms, name, Histogram)
+
+def timer(name):
+    return Timer(histogram(name))
+
+def gauge(name, fn):
+    REGISTRY.gauges[name] = fn
+    pass
+
+def metrics_path(component, pid):
+    return METRICS_PATH % (os.getuid(), component, pid)
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno != errno.ESRCH
+    return True
+
+def sockets(component):
+    """{pid: path} of the sockets of this user's processes of component,
+    removing those left behind by processes which have exited."""
+    found = {}
+    for path in glob.glob(metrics_path(component, "*")):
+        m = re.search(r"-(\d+)\.sock$", path)
+        if not m:
+            continue
+        pid = int(m.group(1))
+        if is_alive(pid):
+            found[pid] = path
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return found
+
+def serve(component, path=None):
+    """Serve the snapshots of this process on a unix socket in a daemon
+    thread. A client sends one command line and reads the JSON answer.
+    The socket is this process's own, so only a stale one left by an
+    earlier process with the same pid is replaced."""
+    path = path or metrics_path(component, os.getpid())
+    sockets(component)
+    if os.path.exists(path):
+        try:
+            os.unlink(path)
+        except OSError, err:
+            print "Exception:metrics.py:serve():", path, err
+            return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(4)
+    def loop():
+        while True:
+            try:
+                conn, _ = sock.accept()
+                conn.settimeout(1.0)
+                try:
+                    cmd = conn.recv(256)
+                except socket.timeout:
+                    cmd = ""
+                conn.sendall(json.dumps(REGISTRY.handle(cmd), sort_keys=True) + "\n")
+                conn.close()
+            except Exception, err:
+                print "Exception:metrics.py:serve():", err
+        pass
+    t = threading.Thread(target=loop, args=())
+    t.daemon = True
+    t.start()
+    if PROFILE:
+        REGISTRY.profile(True)
+    return path
+
+def query(component, cmd="metrics", pid=None):
+    """The answer of the process pid of component, or {pid: answer} of all
+    its running processes if pid is None."""
+    if pid is None:
+        return dict((p, query(component, cmd, p)) for p in sockets(component))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(metrics_path(component, pid))
+    sock.sendall(cmd + "\n")
+    chunks = []
+    while True:
+        s = sock.recv(65536)
+        if not s:
+            break
+        chunks.append(s)
+    return json.loads("".join(chunks))
+
+if __name__=="__main__":
+    if len(sys.argv) < 2:
+        print "Usage: metrics.py <component>[:pid] [metrics|profile on|profile off|profile]"
+        sys.exit(1)
+    component, _, pid = sys.argv[1].partition(":")
+    print json.dumps(query(component, " ".join(sys.argv[2:]) or "metrics", int(pid) if pid else None),
+                     indent=2, sort_keys=True)
+    sys.exit(0)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Columnar model of the nodes' metrics for the GUI. Every metric is one
+# NumPy array indexed by the node's slot, so that updates are a few array
+# stores and the cluster-wide numbers are vectorized reductions instead of
+# side effects of drawing the tiles.
+#
+
+import re
+import numpy
+
+class NodeModel(object):
+    """Struct-of-arrays of the states the nodes maintain."""
+    def __init__(self, size):
+        self.size = size
+        self.ts = numpy.zeros(size)                 # Timestamp for the last message
+        self.load = numpy.zeros(size)               # 1 min average load
+        self.cpu_count = numpy.ones(size)           # Num of CPU cores
+        self.mem_used = numpy.zeros(size)           # Used mem
+        self.mem_total = numpy.ones(size)           # Total physic mem
+        self.rr = numpy.zeros(size)                 # The eth interface recv rate
+        self.tr = numpy.zeros(size)                 # The eth interface send rate
+        self.user_count = numpy.zeros(size, dtype=numpy.int32)  # Num of login users
+        self.disk = [""] * size                     # Disk usage
+        self.rx = [""] * size                       # Total data recv by eth
+        self.tx = [""] * size                       # Total data send by eth
+        pass
+
+    def grow(self, size):
+        """Make room for size nodes, keeping the current ones."""
+        if size <= self.size:
+            return
+        n = size - self.size
+        for name in ("ts", "load", "mem_used", "rr", "tr"):
+            setattr(self, name, numpy.concatenate((getattr(self, name), numpy.zeros(n))))
+        for name in ("cpu_count", "mem_total"):
+            setattr(self, name, numpy.concatenate((getattr(self, name), numpy.ones(n))))
+        self.user_count = numpy.concatenate((self.user_count, numpy.zeros(n, dtype=numpy.int32)))
+        for name in ("disk", "rx", "tx"):
+            getattr(self, name).extend([""] * n)
+        self.size = size
+        pass
+
+    def update(self, slot, data):
+        """Store a node report in its slot."""
+        self.ts[slot] = data["recv_ts"]
+        self.load[slot] = data["load"]
+        self.cpu_count[slot] = max(data["cpu_count"], 1)
+        self.mem_used[slot] = data["mem_used"]
+        self.mem_total[slot] = max(data["mem_total"], 1)
+        self.rr[slot] = data["rr"]
+        self.tr[slot] = data["tr"]
+        self.user_count[slot] = data["user_count"]
+        self.disk[slot] = data["disk"]
+        self.rx[slot] = data["rx"]
+        self.tx[slot] = data["tx"]
+        pass
+
+    def load_ratio(self):
+        return numpy.minimum(self.load / self.cpu_count, 1.0)
+
+    def mem_ratio(self):
+        return numpy.minimum(self.mem_used / self.mem_total, 1.0)
+
+    def fresh(self, now, age=60):
+        """Boolean mask of the nodes heard from within age seconds."""
+        return now - self.ts < age
+
+    def totals(self):
+        """Cluster-wide recv and send rates."""
+        return int(self.rr.sum()), int(self.tr.sum())
+
+    pass
+
+def short_name(name):
+    """The host part of a nodename, so "ukko001.hpc.cs.helsinki.fi" and
+    "ukko001" are the same node. IP addresses are kept whole."""
+    if re.match(r"^\d+(\.\d+){3}$", name):
+        return name
+    return name.split(".")[0]
+
+class NodeRegistry(object):
+    """The nodes' slots in the model, in the order the hosts were first
+    seen, keyed by their short names. The model grows as new hosts appear,
+    and on_new(slot, name) is called for each of them."""
+    def __init__(self, model, names=(), on_new=None):
+        self.model = model
+        self.on_new = on_new
+        self.slots = {}
+        self.names = []
+        for name in names:
+            self.slot(name)
+        pass
+
+    def __len__(self):
+        return len(self.names)
+
+    def slot(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            name = short_name(name)
+            slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.names)
+            self.names.append(name)
+            if slot >= self.model.size:
+                self.model.grow(max(2*self.model.size, slot + 1))
+            if self.on_new:
+                self.on_new(slot, name)
+        return slot
+
+    pass
+
+def column(name):
+    """A read-only property exposing model.<name>[self.id] on a node view."""
+    def get(self):
+        return getattr(self.model, name)[self.id]
+    return property(get)
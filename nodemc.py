@@ -12,18 +12,39 @@ import re
 import os
 import sys
 import time
+import struct
 import random
-import pickle
 import socket
 import threading
 import subprocess
 import multiprocessing
+from collector import *
+from wire import Encoder, decode_register, encode_register_ack, dumps_legacy
+from policy import ReportPolicy, FULL, HEARTBEAT
+from sampler import Sampler
+from metrics import serve, gauge, counter, histogram, timer
+from gossip import Membership, is_gossip
+from deploy import Deployer, run_with_timeout, DEPLOY_TIMEOUT
+from eventloop import Loop
+from relay import Relay, RELAY_PORT, RELAY_INTERVAL
 
 BPORT = 1980
 DEBUG = True
 REGHOST = None
 REGPORT = 1212
 PACKAGE_LEN = 16*2**10
+DELTA = False
+MGROUP = None                   # Publish to this multicast group instead of the clients
+MPORT = 1212
+MTTL = 1
+SEND_INTERVAL = 10              # Seconds over which the send rates are measured
+SAMPLER = True                  # Carry high-frequency summaries, see sampler.py
+ADAPTIVE = True                 # Suppress unchanged reports, see policy.py
+GOSSIP = False                  # SWIM gossip membership instead of "live" broadcasts
+LOOP = False                    # Run everything on one event loop, see run_loop()
+RELAY = False                   # Report through the subnet's boss, see relay.py
+PICKLE = False                  # Send old pickle frames until every center is upgraded
+BOSS_TIMEOUT = 3                # Seconds of silence after which the boss is not relayed to
 
 class Node(threading.Thread):
     """Monitor the node's stats itself."""
@@ -33,13 +54,30 @@ class Node(threading.Thread):
         self.id = random.randint(0, 65535)
         self.ip, self.eth = self.get_ip_eth()
         self.interval = 1
-        self.last_update = time.time()
-        self.rx, self.tx = 0, 0
+        self.collectors = default_collectors(self.eth)
+        self.encoder = Encoder(DELTA)
+        self.policy = ReportPolicy() if ADAPTIVE else None
+        self.sampler = Sampler(self.eth) if SAMPLER else None
         self.clients = {}
+        self.sent_bytes, self.sent_packets = 0, 0
+        self.last_counted = time.time()
+        self.send_rates = { "bytes": 0.0, "packets": 0.0, "interval": 0.0 }
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        if MGROUP:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack("b", MTTL))
         self.bsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.bsock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.membership = Membership(self.id, self.ip, self.gossip_send) if GOSSIP else None
+        self.deployer = Deployer(self.start_agent)
+        # The batches of a relay only carry binary frames
+        self.relay = Relay(os.uname()[1]) if RELAY and not PICKLE else None
+        self.loop = None
         self.event = threading.Event()
+        self.register_metrics()
+        if LOOP:
+            return
+        if self.sampler:
+            self.sampler.start()
         t1 = threading.Thread(target=self.registrar, args=())
         t1.daemon = True
         t1.start()
@@ -49,12 +87,53 @@ class Node(threading.Thread):
         t3 = threading.Thread(target=self.probe, args=())
         t3.daemon = True
         t3.start()
+        if self.relay:
+            t4 = threading.Thread(target=self.relay_service, args=())
+            t4.daemon = True
+            t4.start()
+        pass
+
+    def register_metrics(self):
+        """Serve the node's own costs, see metrics.py."""
+        gauge("send", lambda: dict(self.send_rates, clients=len(self.clients)))
+        gauge("deploy", self.deployer.counters)
+        if self.policy:
+            gauge("reports", self.policy.counters)
+        if self.sampler:
+            gauge("sampler", self.sampler.counters)
+        if self.membership:
+            gauge("gossip", self.membership.counters)
+        if self.relay:
+            gauge("relay", self.relay.counters)
+        try:
+            serve("nodemc")
+        except Exception, err:
+            print "Exception:nodemc.py:Node.register_metrics():", err
         pass
 
     def broadcast(self, msg):
         self.bsock.sendto(msg, ("<broadcast>", BPORT))
         pass
 
+    def gossip_send(self, msg, ip):
+        self.bsock.sendto(msg, (ip, BPORT))
+        pass
+
+    def is_boss(self):
+        if self.membership:
+            return self.membership.boss() == self.ip
+        return self.id == max(self.agents.keys())
+
+    def boss_ip(self):
+        """The boss's ip, or None if the broadcast-elected boss has not been
+        heard for BOSS_TIMEOUT, so that no report is sent to a dead one."""
+        if self.membership:
+            return self.membership.boss()
+        if not self.agents:
+            return None
+        ip, ts = self.agents[max(self.agents.keys())]
+        return ip if time.time() - ts < BOSS_TIMEOUT else None
+
     def get_ip_eth(self):
         ip = subprocess.Popen(["hostname","-I"], stdout=subprocess.PIPE).communicate()[0].split()[0]
         eth = "eth2"
@@ -69,67 +148,193 @@ class Node(threading.Thread):
         app_path = os.path.realpath(__file__)
         return app_path
 
+    def get_app_args(self):
+        """The arguments the agents are started with, so they publish the
+        same way as this node."""
+        args = "%s %i" % (MGROUP, MTTL) if MGROUP else ""
+        if LOOP:
+            args = "--loop " + args
+        if RELAY:
+            args = "--relay " + args
+        if PICKLE:
+            args = "--pickle " + args
+        return "--gossip " + args if GOSSIP else args
+
     def probe(self):
         t0 = time.time()
         while True:
             try:
-                t1 = time.time()
-                t = max(int(t1 - t0), 1)
-                self.broadcast("live" + str(self.id))
-                if t % 60 == 0:
-                    if len(self.agents) < 2:
-                        self.start_possible_agents()
-                    for agid, agtp in self.agents.items():
-                        agip, agtm = agtp
-                        if t1 - agtm > 300:
-                            self.agents.pop(agid)
-                            if self.id == max(self.agents.keys()):
-                                self.start_agent(agip)
-                if t % 3600 == 0 and self.id == max(self.agents.keys()):
-                    self.start_possible_agents()
-                time.sleep(1)
+                self.probe_once(t0)
             except Exception, err:
                 if DEBUG:
                     print "Exception:node.py:Node.probe():", err
+            time.sleep(1)
+        pass
+
+    def probe_once(self, t0):
+        """One second of membership upkeep, t0 being the start time."""
+        t1 = time.time()
+        t = max(int(t1 - t0), 1)
+        if self.membership:
+            self.membership.tick(t1)
+            self.agents = self.membership.agents()
+            dead = self.membership.take_dead()
+            if dead and self.is_boss():
+                self.deployer.deploy(dead)
+        else:
+            self.broadcast("live" + str(self.id))
+        if t % 60 == 0:
+            self.expire_clients()
+            if self.membership and DEBUG:
+                print "Gossip:", self.membership.counters()
+            if DEBUG:
+                print "Send:", self.send_rates
+                print "Deploy:", self.deployer.counters()
+                if self.policy:
+                    print "Reports:", self.policy.counters()
+                if self.sampler:
+                    print "Sampler:", self.sampler.counters()
+            if len(self.agents) < 2:
+                self.start_possible_agents()
+        if not self.membership:
+            for agid, agtp in self.agents.items():
+                agip, agtm = agtp
+                if t1 - agtm > 300:
+                    self.agents.pop(agid)
+                    if self.agents and self.is_boss():
+                        self.deployer.deploy([agip])
+        if t % 3600 == 0 and self.is_boss():
+            self.start_possible_agents()
         pass
 
     def send(self, data):
+        """Publish a report, or hand it to the boss in relay mode."""
+        if self.relay and self.forward(data):
+            return
+        self.publish(data)
+        pass
+
+    def forward(self, data):
+        """Send a report to the relay, i.e. the boss, or hold it there if
+        this node is the boss. False if there is no live boss, and the
+        report is to be published directly."""
+        boss = self.boss_ip()
+        if boss is None:
+            return False
+        if boss == self.ip:
+            self.relay.add(data)
+        else:
+            self.sock.sendto(data, (boss, RELAY_PORT))
+            counter("relay.forwarded").inc()
+        return True
+
+    def flush_relay(self):
+        for data in self.relay.flush():
+            self.publish(data)
+        pass
+
+    def relay_service(self):
+        """Collect the neighbours' reports and forward them every
+        RELAY_INTERVAL."""
+        sock = self.relay_socket()
+        next_t = time.time() + RELAY_INTERVAL
+        while True:
+            try:
+                sock.settimeout(max(next_t - time.time(), 1e-3))
+                self.relay.add(sock.recv(2**16))
+            except socket.timeout:
+                pass
+            except Exception, err:
+                print "Exception:Node.relay_service():", err
+            if time.time() >= next_t:
+                next_t = max(next_t + RELAY_INTERVAL, time.time())
+                self.flush_relay()
+        pass
+
+    def relay_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", RELAY_PORT))
+        return sock
+
+    def publish(self, data):
+        t0 = time.time()
+        sent = 0
         try:
-            for client, ts in self.clients.items():
-                try:
-                    if time.time() - ts < 800:
-                        self.sock.sendto(data + "\n", client)
-                    else:
-                        del self.clients[client]
-                except Exception, err:
-                    print "Exception:node.py:Node.send():for_loop", err
+            if MGROUP:
+                self.sock.sendto(data, (MGROUP, MPORT))
+                sent += 1
+            else:
+                for client in self.clients.keys():
+                    try:
+                        self.sock.sendto(data, client)
+                        sent += 1
+                    except Exception, err:
+                        counter("send.errors").inc()
+                        print "Exception:node.py:Node.publish():for_loop", err
+            self.sent_bytes += len(data) * sent
+            self.sent_packets += sent
+            histogram("send.time").observe(time.time() - t0)
+            counter("send.packets").inc(sent)
+            counter("send.bytes").inc(len(data) * sent)
             if DEBUG:
-                print("Send %i bytes message to %i clients, %i active nodes, boss:%s" %
-                      (len(data), len(self.clients), len(self.agents), self.agents[max(self.agents.keys())][0]))
+                print("Send %i bytes message to %s, %i active nodes, boss:%s" %
+                      (len(data), MGROUP if MGROUP else "%i clients" % len(self.clients),
+                       len(self.agents), self.agents[max(self.agents.keys())][0]))
         except Exception, err:
             if DEBUG:
-                print "Exception:node.py:Node.send():", err
+                print "Exception:node.py:Node.publish():", err
 
-    def start(self):
+    def send_counters(self):
+        """Bytes and packets sent per second since the last call, and the
+        interval."""
+        t = time.time()
+        dt = max(t - self.last_counted, 1e-6)
+        counters = { "bytes": self.sent_bytes / dt, "packets": self.sent_packets / dt,
+                     "interval": dt }
+        self.sent_bytes, self.sent_packets = 0, 0
+        self.last_counted = t
+        return counters
+
+    def expire_clients(self):
+        """Forget the listeners which have not registered for 800s."""
+        for client, ts in self.clients.items():
+            if time.time() - ts >= 800:
+                self.clients.pop(client, None)
+        pass
+
+    def broadcast_socket(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(("", BPORT))
+        return sock
+
+    def handle_broadcast(self, msg, addr):
+        """Handle a message from the other agents. Return False on exit."""
+        cmd, args = msg[0:4], msg[4:]
+        if self.membership and is_gossip(msg):
+            self.membership.receive(msg, addr)
+        elif cmd == "helo":
+            if addr[0] != self.ip:
+                self.broadcast("agid" + str(111))
+        elif cmd == "live":
+             self.agents[int(args)] = (addr[0], time.time())
+             if self.id == int(args) and self.ip != addr[0]:
+                 old_id = self.id
+                 self.id = random.randint(0, 65535)
+                 self.broadcast("dele" + str(old_id))
+        elif cmd == "dele":
+            self.agents.pop(int(args))
+        elif cmd == "exit":
+            return False
+        return True
+
+    def start(self):
+        sock = self.broadcast_socket()
         while not self.event.isSet():
             try:
-                msg, addr = sock.recvfrom(PACKAGE_LEN)
-                cmd, args = msg[0:4], msg[4:]
-                if cmd == "helo":
-                    if addr[0] != self.ip:
-                        self.broadcast("agid" + str(111))
-                elif cmd == "live":
-                     self.agents[int(args)] = (addr[0], time.time())
-                     if self.id == int(args) and self.ip != addr[0]:
-                         old_id = self.id
-                         self.id = random.randint(0, 65535)
-                         self.broadcast("dele" + str(old_id))
-                elif cmd == "dele":
-                    self.agents.pop(int(args))
-                elif cmd == "exit":
+                msg, addr = sock.recvfrom(2**16)
+                if not self.handle_broadcast(msg, addr):
                     break
             except KeyboardInterrupt:
                 break
@@ -137,17 +342,46 @@ class Node(threading.Thread):
                 print "Exception:Node.start():", err
         pass
 
+    def run_loop(self):
+        """Run the broadcasts, the registrations, the probe, the reports and
+        the sampler on one event loop instead of start() and the threads.
+        The ticks run on a fixed grid, and nothing shares self.agents or
+        self.clients across threads. The deployments still run on the
+        deployer's workers."""
+        loop = self.loop = Loop()
+        bsock = self.broadcast_socket()
+        rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rsock.bind((self.ip, REGPORT))
+        def on_broadcast(msg, addr):
+            if not self.handle_broadcast(msg, addr):
+                loop.stop()
+            pass
+        loop.add_datagram(bsock, on_broadcast)
+        loop.add_datagram(rsock, lambda data, addr: self.handle_register(rsock, data))
+        t0 = time.time()
+        loop.call_every(1, lambda: self.probe_once(t0))
+        loop.call_every(lambda: self.policy.interval if self.policy else self.interval,
+                        self.report_stats, self.interval)
+        if self.sampler:
+            loop.call_every(lambda: 1.0/self.sampler.hz, self.sampler.step)
+        if self.relay:
+            loop.add_datagram(self.relay_socket(), lambda data, addr: self.relay.add(data))
+            loop.call_every(RELAY_INTERVAL, self.flush_relay, RELAY_INTERVAL)
+        gauge("loop", loop.counters)
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            pass
+        pass
+
     def start_possible_agents(self):
         all_agents = self.get_all_possible_agents(self.ip)
         active_agents = set()
         for k, v in self.agents.items():
             ip, ts = v
             active_agents.add(ip)
-        for agent in all_agents:
-            if agent != self.ip and agent not in active_agents:
-                t = threading.Thread(target=self.start_agent, args=(agent,))
-                t.daemon = True
-                t.start()
+        self.deployer.deploy([ agent for agent in all_agents
+                               if agent != self.ip and agent not in active_agents ])
         pass
 
     def get_all_possible_agents(self, ip):
@@ -160,19 +394,18 @@ class Node(threading.Thread):
             agents.append(agent_ip)
         return agents
 
-    def start_agent(self, ip):
-        """Start the agent on a node based on given ip."""
-        ret = subprocess.call("ssh -o BatchMode=yes -o StrictHostKeyChecking=no %s 'screen -dmS NodeMonitor %s; exit'" %
-                              (ip,self.get_app_path()),
-                              shell=True,
-                              stdout=open('/dev/null', 'w'),
-                              stderr=subprocess.STDOUT)
+    def start_agent(self, ip, timeout=DEPLOY_TIMEOUT):
+        """Start the agent on a node based on given ip. Return the exit code
+        of ssh, or None if it did not finish within timeout seconds."""
+        ret = run_with_timeout("ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o ConnectTimeout=%i %s 'screen -dmS NodeMonitor %s %s; exit'" %
+                               (timeout,ip,self.get_app_path(),self.get_app_args()),
+                               timeout)
         return ret
 
     def report_service(self):
         while True:
             try:
-                time.sleep(self.interval)
+                time.sleep(self.policy.interval if self.policy else self.interval)
                 self.report_stats()
             except Exception, err:
                 print "Exception:Node.report_service():", err
@@ -184,12 +417,18 @@ class Node(threading.Thread):
         sock.bind((REGHOST, REGPORT))
         while not self.event.isSet():
             try:
-                client = pickle.loads(sock.recv(1024))
-                self.clients[client] = time.time()
+                self.handle_register(sock, sock.recv(1024))
             except Exception, err:
                 print "Exception:Node.registrar():", err
         pass
 
+    def handle_register(self, sock, data):
+        """Register a listener, and ack it from sock."""
+        client = decode_register(data)
+        self.clients[client] = time.time()
+        sock.sendto(encode_register_ack(os.uname()[1], client), client)
+        pass
+
     def report_stats(self):
         """Some information is commented out since I don't need them at
         the moment. Then I can save some bandwidth."""
@@ -203,40 +442,22 @@ class Node(threading.Thread):
         #stats["release"] = uname[2]
         #stats["version"] = uname[3]
         #stats["machine"]  = uname[4]
-        # uptime
-        s = subprocess.Popen("uptime", stdout=subprocess.PIPE).communicate()[0]
-        stats["user_count"] = re.search(r"(\d+) user", s).groups()[0]
-        stats["load"] = re.search(r"load average: (.+?),", s).groups()[0]
-        #stats["up"] = re.search(r"up (.+?),", s).groups()[0]
-        stats["cpu_count"] = multiprocessing.cpu_count()
-        # free -m
-        s = subprocess.Popen(["free", "-m"], stdout=subprocess.PIPE).communicate()[0]
-        s = re.search(r"Mem:.*?(\d+)\W+(\d+)\W+(\d+)", s, re.I).groups()
-        stats["mem_total"] = s[0]
-        stats["mem_used"] = s[1]
-        # how many unique users are there
-        #stats["user_uniq"] = int(subprocess.Popen("who | cut -d ' ' -f 1 | sort | uniq | wc -l", shell=True, stdout=subprocess.PIPE).communicate()[0])
-        # df -h
-        s = subprocess.Popen(["df", "-h", "/"], stdout=subprocess.PIPE).communicate()[0]
-        stats["disk"] = re.search(r"(\d+%)", s).group(0)
-        # ifconfig
-        interval = time.time() - self.last_update
-        s = subprocess.Popen(["ifconfig", self.eth], stdout=subprocess.PIPE).communicate()[0]
-        m = re.search(r"RX.*?(\d+).*?\((.*?)\)", s).groups()
-        stats["rx"] = m[1]
-        rx0, rx1 = self.rx, int(m[0])
-        self.rx = rx1
-        stats["rr"] = int((rx1-rx0)/interval)
-        m = re.search(r"TX.*?(\d+).*?\((.*?)\)", s).groups()
-        stats["tx"] = m[1]
-        tx0, tx1 = self.tx, int(m[0])
-        stats["tr"] = int((tx1-tx0)/interval)
-        self.tx = tx1
-        self.last_update = time.time()
+        # uptime, free, df and ifconfig, read from /proc and friends
+        with timer("collect"):
+            self.collectors.collect(stats)
+        if self.sampler:
+            stats.update(self.sampler.summary())
 
         # serialization
-        data = pickle.dumps(stats, pickle.HIGHEST_PROTOCOL)
-        self.send(data)
+        if stats["timestamp"] - self.last_counted >= SEND_INTERVAL:
+            self.send_rates = self.send_counters()
+        kind = self.policy.decide(stats, stats["timestamp"]) if self.policy else FULL
+        if kind and PICKLE:
+            self.send(dumps_legacy(stats))
+        elif kind == FULL:
+            self.send(self.encoder.encode(stats))
+        elif kind == HEARTBEAT:
+            self.send(self.encoder.heartbeat(stats))
         pass
 
     pass
@@ -253,8 +474,26 @@ def is_running(fn):
 
 
 if __name__=="__main__":
+    # Usage: nodemc.py [--gossip] [--loop] [--relay] [--pickle] [multicast_group [ttl]]
+    while len(sys.argv) > 1 and sys.argv[1] in ("--gossip", "--loop", "--relay", "--pickle"):
+        flag = sys.argv.pop(1)
+        if flag == "--gossip":
+            GOSSIP = True
+        elif flag == "--loop":
+            LOOP = True
+        elif flag == "--relay":
+            RELAY = True
+        else:
+            PICKLE = True
+    if len(sys.argv) > 1:
+        MGROUP = sys.argv[1]
+    if len(sys.argv) > 2:
+        MTTL = int(sys.argv[2])
     if not is_running(__file__):
         node = Node()
-        node.start()
+        if LOOP:
+            node.run_loop()
+        else:
+            node.start()
         print "Node monitor stops"
     sys.exit(0)
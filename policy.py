@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# Adaptive reporting policy of nodemc. A full report is only sent when a
+# metric moved by more than its significance threshold since the last full
+# report; otherwise a small heartbeat tells the center that the node is
+# alive and its metrics are unchanged. While metrics are changing the node
+# samples and reports every FAST_INTERVAL, and it slows down to
+# IDLE_INTERVAL once they have settled for FAST_HOLD seconds.
+#
+
+FULL = 1
+HEARTBEAT = 2
+
+FAST_INTERVAL = 1.0             # Sampling interval while metrics change
+IDLE_INTERVAL = 5.0             # Sampling interval of an idle node
+FAST_HOLD = 10.0                # Seconds of calm before slowing down
+HEARTBEAT_INTERVAL = 10.0       # Max silence of an idle node
+FULL_INTERVAL = 60.0            # A full report at least this often anyway
+
+#              metric        absolute  relative
+THRESHOLDS = { "load":       (0.1,     0.10),
+               "cpu_count":  (0.5,     0.0),
+               "mem_total":  (0.5,     0.0),
+               "mem_used":   (64,      0.05),
+               "user_count": (0.5,     0.0),
+               "disk_pct":   (0.5,     0.0),
+               "rr":         (64*1024, 0.25),
+               "tr":         (64*1024, 0.25),
+               "rr_max":     (1*2**20, 0.50),      # Bursts seen by the sampler
+               "tr_max":     (1*2**20, 0.50),
+               "cpu_max":    (100,     0.0) }
+
+class ReportPolicy(object):
+    """Decide what to send for every sample, and how long to wait before
+    the next one."""
+    def __init__(self, thresholds=THRESHOLDS):
+        self.thresholds = thresholds
+        self.last = None                 # Metrics of the last full report
+        self.last_full = 0.0
+        self.last_sent = 0.0
+        self.fast_until = 0.0
+        self.interval = FAST_INTERVAL
+        self.full, self.heartbeats, self.suppressed = 0, 0, 0
+        pass
+
+    def changed(self, stats):
+        """The metrics that moved significantly since the last full report."""
+        if self.last is None:
+            return list(self.thresholds)
+        moved = []
+        for k, (absolute, relative) in self.thresholds.iteritems():
+            old, new = self.last.get(k, 0), stats.get(k, 0)
+            if abs(new - old) > max(absolute, relative*abs(old)):
+                moved.append(k)
+        return moved
+
+    def decide(self, stats, now):
+        """FULL, HEARTBEAT or None for a sample taken at now."""
+        moved = self.changed(stats)
+        if moved:
+            self.fast_until = now + FAST_HOLD
+        self.interval = FAST_INTERVAL if now < self.fast_until else IDLE_INTERVAL
+        if moved or now - self.last_full >= FULL_INTERVAL:
+            self.last = dict((k, stats.get(k, 0)) for k in self.thresholds)
+            self.last_full = self.last_sent = now
+            self.full += 1
+            return FULL
+        if now - self.last_sent >= HEARTBEAT_INTERVAL - 0.5*self.interval:
+            self.last_sent = now
+            self.heartbeats += 1
+            return HEARTBEAT
+        self.suppressed += 1
+        return None
+
+    def counters(self):
+        return { "full": self.full, "heartbeats": self.heartbeats,
+                 "suppressed": self.suppressed, "interval": self.interval }
+
+    pass
@@ -6,23 +6,58 @@
 # 2011.03.07
 #
 
-import re
 import wx
+import re
 import time
+import math
+import heapq
+import numpy
 import random
 import threading
 import subprocess
 import multiprocessing
 from centermc import *
 from myutil import *
+from ingest import Ingest
+from model import NodeModel, NodeRegistry, column
+from history import SpeedHistory
+from render import DrawCache, DrawBatch, bar_rects
+from metrics import serve, gauge, histogram, timer
+
+POLL_INTERVAL = 0.1             # How often the state table is read
+STALE_AGE = 60                  # Nodes silent for longer are drawn grey
+SEED_NODES = [ "ukko%03i" % (i+1) for i in range(240) ]   # Laid out first, in order
+MATRIX_X, MATRIX_Y = 16, 15     # Grid that fits the frame while not zoomed
+LOD_WIDTH = 40                  # Narrower tiles are drawn as a heatmap
+ZOOM_STEP = 1.25
+MIN_TILE, MAX_TILE = 2, 600
 
 class Node(object):
-    def __init__(self, id=None, parent=None):
+    """A tile of the frame, a thin view of the node's slot in the model."""
+    __slots__ = ("id", "parent", "model", "name", "highlight", "fontsize", "fz",
+                 "x", "y", "w", "h", "plx", "ply", "plw", "plh", "pmx", "pmy", "pmw", "pmh",
+                 "r", "rn", "history")
+
+    ts = column("ts")                    # Timestamp for the last message
+    load = column("load")                # 1 min average load
+    cpu_count = column("cpu_count")      # Num of CPU cores
+    mem_used = column("mem_used")        # Used mem
+    mem_total = column("mem_total")      # Total physic mem
+    user_count = column("user_count")    # Num of login users
+    disk = column("disk")                # Disk usage
+    rx = column("rx")                    # Total data recv by eth
+    tx = column("tx")                    # Total data send by eth
+    rr = column("rr")                    # The eth interface recv rate
+    tr = column("tr")                    # The eth interface send rate
+
+    def __init__(self, id=None, parent=None, name=None):
         self.id = id
         self.parent = parent
-        self.name = "n%03i" % (id+1)
+        self.model = parent.model
+        self.name = name.split(".")[0] if name else "n%03i" % (id+1)
         self.highlight = False
         self.fontsize = 8
+        self.fz = 8
         self.x, self.y = 0, 0
         self.w, self.h = 100, 100
         self.plx, self.ply = 9, 9
@@ -30,46 +65,23 @@ class Node(object):
         self.pmx, self.pmy = 9, 9
         self.pmw, self.pmh = 9, 9
         self.r, self.rn = 3, 30.0        # Radius and Max num of histories
-        self.rr_history = [1]
-        self.tr_history = [1]
-        # The states a node maintains
-        self.ts = 0                      # Timestamp for the last message
-        self.load = 0.0                  # 1 min average load
-        self.cpu_count = 1.0             # Num of CPU cores
-        self.mem_used = 0.0              # Used mem
-        self.mem_total = 1.0             # Total physic mem
-        self.user_count = 0              # Num of login users
-        self.user_uniq = 0               # Num of uniq users
-        self.disk = ""                   # Disk usage
-        self.rx = ""                     # Total data recv by eth
-        self.tx = ""                     # Total data send by eth
-        self.rr = 0                      # The eth interface recv rate
-        self.tr = 0                      # The eth interface send rate
+        self.history = SpeedHistory(self.rn)
         pass
 
-    def draw(self, dc):
+    def draw(self, dc, batch):
         self.draw_text_info(dc)
-        self.draw_node_loadbar(dc, self.load/self.cpu_count, self.mem_used/self.mem_total)
-        self.draw_speed_curve(dc)
-        self.draw_frame(dc)
-        self.parent.rr_total += self.rr
-        self.parent.tr_total += self.tr
+        self.draw_node_loadbar(dc, batch, self.load/self.cpu_count, self.mem_used/self.mem_total)
+        self.draw_speed_curve(batch)
+        self.draw_frame(batch)
         pass
 
-    def draw_frame(self, dc):
-        x, y, w, h = self.x, self.y, self.w, self.h
-        if self.highlight:
-            dc.SetPen(wx.Pen('red', 2))
-        else:
-            dc.SetPen(wx.Pen(wx.Colour(64,64,64), 1))
-        dc.SetBrush(wx.TRANSPARENT_BRUSH)
-        dc.DrawRectangle(x, y, w, h)
+    def draw_frame(self, batch):
+        batch.add("highlight" if self.highlight else "frame", "none", (self.x, self.y, self.w, self.h))
         pass
 
     def draw_text_info(self, dc):
         x, y, w, h, fz = self.x, self.y, self.w, self.h, self.fz
-        dc.SetFont(wx.Font(fz, wx.FONTFAMILY_SWISS,wx.FONTSTYLE_NORMAL,wx.FONTWEIGHT_NORMAL))
-        if time.time() - self.ts < 60:
+        if time.time() - self.ts < STALE_AGE:
             dc.SetTextForeground('green')
         else:
             dc.SetTextForeground('grey')
@@ -80,59 +92,48 @@ class Node(object):
             dc.DrawText("R:%s T:%s" % (self.rx, self.tx), x+2, y+fz+3)
         pass
 
-    def draw_node_loadbar(self, dc, load, mem):
+    def draw_node_loadbar(self, dc, batch, load, mem):
         load = load if load <= 1 else 1.0
         mem  = mem  if mem  <= 1 else 1.0
-        x, y, w, h = self.x, self.y, self.w, self.h
         plx, ply, plw, plh = self.plx, self.ply, self.plw, self.plh
         pmx, pmy, pmw, pmh = self.pmx, self.pmy, self.pmw, self.pmh
-        dc.SetPen(wx.Pen('black', 0, wx.TRANSPARENT))
-        dc.SetBrush(wx.BLACK_BRUSH)
         dc.GradientFillLinear((plx+1,ply+1,plw-2,plh-2), 'green', 'red')
         dc.GradientFillLinear((pmx+1,pmy+1,pmw-2,pmh-2), 'green', 'red')
-        dc.DrawRectangle(plx+plw*load+1,ply+1,plw*(1-load)-1,plh-2)
-        dc.DrawRectangle(pmx+pmw*mem+1,pmy+1,pmw*(1-mem)-1,pmh-2)
+        batch.add("none", "black", [ (plx+plw*load+1,ply+1,plw*(1-load)-1,plh-2),
+                                     (pmx+pmw*mem+1,pmy+1,pmw*(1-mem)-1,pmh-2) ])
         pass
 
-    def draw_speed_curve(self, dc):
+    def draw_speed_curve(self, batch):
         x, y, w, h, r = self.x, self.y, self.w, self.h, self.r
-        rn = int(w/r)
-        self.rr_history.append(self.rr)
-        self.tr_history.append(self.tr)
-        norm = max(max(self.rr_history), max(self.tr_history))
+        norm = self.history.norm()
         self.parent.norm = max(norm, self.parent.norm)
         norm = 3.5*self.parent.norm
-        self.rr_history = self.rr_history[-rn:]
-        self.tr_history = self.tr_history[-rn:]
-        dc.SetPen(wx.Pen("cyan", 0, wx.TRANSPARENT))
-        dc.SetBrush(wx.GREEN_BRUSH)
-        for i in range(1, len(self.rr_history)):
-            rr = self.rr_history[-i]
-            rh = int(h*rr/(norm))
-            ry = y + h - rh
-            rx = x + w - i*r
-            rd = int(r/2)
-            dc.DrawRectangle(rx-rd, ry, r-1, rh)
-        dc.SetPen(wx.Pen("cyan", 0, wx.TRANSPARENT))
-        dc.SetBrush(wx.RED_BRUSH)
-        for i in range(1, len(self.tr_history)):
-            tr = self.tr_history[-i]
-            th = int(h*tr/(norm))
-            ty = y + h - th
-            tx = x + w - i*r
-            dc.DrawRectangle(tx, ty, r-1, th)
+        batch.add("none", "green", bar_rects(self.history.a.values(), x, y, w, h, r, norm, int(r/2)))
+        batch.add("none", "red", bar_rects(self.history.b.values(), x, y, w, h, r, norm))
         pass
 
 class MyFrame(wx.Frame):
-    def __init__(self, parent, title, size):
-        self.matrix_x, self.matrix_y = 16, 15
-        self.nodes = [ Node(i, self) for i in range(self.matrix_x*self.matrix_y) ]
+    def __init__(self, parent, title, size, queue=None):
+        self.model = NodeModel(len(SEED_NODES))
+        self.nodes = []
+        self.registry = NodeRegistry(self.model, SEED_NODES, self.add_node)
         self.norm = 10
+        self.drawn_norm = self.norm
         self.nodes_lock = threading.Lock()
-        self.rr_total = 0
-        self.tr_total = 0
+        self.dirty = set()               # Tiles to redraw into the back buffer
+        self.expiry = []                 # Heap of (time a node turns stale, id)
+        self.expiring = set()
+        self.buffer = None
+        self.zoom = None                 # Tile width, or None to fit the frame
+        self.scroll = 0                  # Pixels scrolled down
+        self.grid = (1, 1, 1, 0, 0)      # cols, tile w, tile h, first and end visible id
+        self.relayout = False            # Set when new nodes join the grid
+        self.ingest = Ingest(None, queue, registry=self.registry) if queue else \
+                      Ingest(STATE, None, registry=self.registry)
         self.power_consumption = get_pc_mikko()
         wx.Frame.__init__(self, parent, wx.ID_ANY, title, size=size)
+        self.cache = DrawCache()
+        self.cache.rebuild(8)
         self.anchor0 = None
         self.anchor1 = None
         self.last_refresh = time.time()
@@ -143,6 +144,8 @@ class MyFrame(wx.Frame):
         wx.EVT_LEFT_DOWN(self, self.on_left_down)
         wx.EVT_LEFT_UP(self, self.on_left_up)
         wx.EVT_MOTION(self, self.on_motion)
+        wx.EVT_MOUSEWHEEL(self, self.on_wheel)
+        wx.EVT_MIDDLE_DOWN(self, self.on_fit)
         wx.EVT_RIGHT_DCLICK(self, self.btexp)
         wx.EVT_CLOSE(self, self.on_close)
         # Start the timer to refresh the frame periodically
@@ -160,19 +163,65 @@ class MyFrame(wx.Frame):
         wx.Frame.Show(self)
         self.on_size()
 
+    def register_metrics(self):
+        """Serve the GUI's costs, from the process that paints it. Called
+        after the listener is forked, so that the child does not inherit
+        the gauges."""
+        gauge("ingest", lambda: dict(self.ingest.counters(), nodes=len(self.nodes)))
+        try:
+            serve("pygui")
+        except Exception, err:
+            print "Exception:pygui.py:MyFrame.register_metrics():", err
+        pass
+
+    def add_node(self, id, name):
+        """Called by the registry when a host is seen for the first time."""
+        self.nodes.append(Node(id, self, name))
+        self.relayout = True
+        pass
+
+    def grid_size(self, scrW, scrH, n):
+        """Num of columns and the tile size for n nodes at the current zoom."""
+        if self.zoom is None:
+            if n <= MATRIX_X*MATRIX_Y:
+                mx, my = MATRIX_X, MATRIX_Y
+            else:
+                mx = int(math.ceil(math.sqrt(n*scrW/float(max(scrH, 1)))))
+                my = int(math.ceil(n/float(mx)))
+            return mx, max(scrW/mx - 2, 1), max(scrH/my - 2, 1)
+        nw = int(self.zoom)
+        return max(scrW/(nw+2), 1), nw, max(int(nw*0.8), 1)
+
     def on_size(self, event=None):
-        mx, my = self.matrix_x, self.matrix_y
         scrW, scrH = wx.PaintDC(self).GetSize()
-        nw, nh = scrW/mx - 2, scrH/my - 2
-        fz = 7 if int(min(nw,nh)/9.5)<7 else int(min(nw,nh)/9.5)
-        r, rn = self.nodes[0].r, self.nodes[0].rn
-        r = 3 if int(r/rn)<3 else int(r/rn)
-        for i in range(my):
-            for j in range(mx):
-                id = i*mx+j
+        self.buffer = wx.EmptyBitmap(max(scrW, 1), max(scrH, 1))
+        self.layout()
+        self.draw_dirty()
+        self.Refresh(False)
+        pass
+
+    def layout(self):
+        """Place the visible tiles and mark them dirty. The tiles out of
+        view keep their model data and history but are not laid out."""
+        scrW, scrH = self.buffer.GetSize()
+        self.nodes_lock.acquire()
+        try:
+            self.relayout = False
+            n = len(self.nodes)
+            mx, nw, nh = self.grid_size(scrW, scrH, n)
+            rows = int(math.ceil(n/float(mx)))
+            self.scroll = max(min(self.scroll, rows*(nh+2) - scrH), 0)
+            i0 = min(self.scroll/(nh+2)*mx, n)
+            i1 = min(((self.scroll + scrH)/(nh+2) + 1)*mx, n)
+            self.grid = (mx, nw, nh, i0, i1)
+            fz = 7 if int(min(nw,nh)/9.5)<7 else int(min(nw,nh)/9.5)
+            r = 3
+            self.cache.rebuild(fz)
+            for id in range(i0, i1):
+                i, j = divmod(id, mx)
                 node = self.nodes[id]
                 node.w, node.h = nw, nh
-                node.x, node.y = (nw+2)*j+2, (nh+2)*i+2
+                node.x, node.y = (nw+2)*j+2, (nh+2)*i+2 - self.scroll
                 node.plx = node.x + 0.02*nw
                 node.ply = node.y + 0.35*nh
                 node.plw = nw*0.95
@@ -183,27 +232,149 @@ class MyFrame(wx.Frame):
                 node.pmh = node.plh
                 node.fz  = fz
                 node.r   = r
-        self.Refresh(False)
+                if nw >= LOD_WIDTH:
+                    node.history.resize(nw/r)
+            self.dirty = set(range(i0, i1))
+            dc = wx.MemoryDC(self.buffer)
+            dc.SetBackground(self.cache.brushes["black"])
+            dc.Clear()
+            dc.SelectObject(wx.NullBitmap)
+        finally:
+            self.nodes_lock.release()
         pass
 
     def on_paint(self, event=None):
+        t0 = time.time()
         dc = wx.PaintDC(self)
-        dc.SetPen(wx.Pen('black', 0))
-        self.nodes_lock.acquire()
-        try:
-            self.draw_nodes(dc)
-        except Exception, err:
-            print "Exception:MyFrame.on_paint():", err
-        self.nodes_lock.release()
+        if self.buffer:
+            dc.DrawBitmap(self.buffer, 0, 0)
         self.draw_select_rect(dc)
-        self.set_frame_title()
         self.last_refresh = time.time()
+        histogram("paint.frame").observe(self.last_refresh - t0)
+        pass
+
+    def on_wheel(self, event=None):
+        """Scroll by rows, or zoom around the top row with Ctrl held."""
+        mx, nw, nh, i0, i1 = self.grid
+        steps = event.GetWheelRotation() / max(event.GetWheelDelta(), 1)
+        if event.ControlDown():
+            first = i0
+            self.zoom = max(min(nw*ZOOM_STEP**steps, MAX_TILE), MIN_TILE)
+            mx, nw, nh = self.grid_size(self.buffer.GetSize()[0], self.buffer.GetSize()[1], len(self.nodes))
+            self.scroll = first/mx*(nh+2)
+        else:
+            self.scroll -= steps*(nh+2)*(1 if nw >= LOD_WIDTH else 4)
+        self.on_viewport()
+        pass
+
+    def on_fit(self, event=None):
+        self.zoom, self.scroll = None, 0
+        self.on_viewport()
+        pass
+
+    def on_viewport(self):
+        if not self.buffer:
+            return
+        self.layout()
+        self.draw_dirty()
+        self.Refresh(False)
         pass
 
     def update(self, event=None):
         self.norm = 10 if self.norm*0.95<10 else self.norm*0.95
-        self.rr_total, self.tr_total = 0, 0
-        self.Refresh(False)
+        if self.relayout and self.buffer:
+            self.layout()
+        if abs(self.norm - self.drawn_norm) > 0.1*self.drawn_norm:
+            self.mark_dirty(range(self.grid[3], self.grid[4]))
+        self.expire_nodes()
+        self.draw_dirty()
+        self.set_frame_title()
+
+    def mark_dirty(self, ids):
+        self.nodes_lock.acquire()
+        self.dirty.update(ids)
+        self.nodes_lock.release()
+        pass
+
+    def expire_nodes(self):
+        """Repaint the nodes whose last report just became older than
+        STALE_AGE, so they turn grey. Every node has at most one entry
+        in the expiry heap."""
+        now = time.time()
+        self.nodes_lock.acquire()
+        while self.expiry and self.expiry[0][0] <= now:
+            t, id = heapq.heappop(self.expiry)
+            expire_at = self.model.ts[id] + STALE_AGE
+            if expire_at > now:
+                heapq.heappush(self.expiry, (expire_at, id))
+            else:
+                self.expiring.discard(id)
+                self.dirty.add(id)
+        self.nodes_lock.release()
+        pass
+
+    def draw_dirty(self):
+        """Redraw the invalidated visible tiles into the back buffer, and
+        refresh only their part of the window. In heatmap mode any dirty
+        node repaints the whole visible heatmap at once."""
+        if not self.buffer:
+            return
+        mx, nw, nh, i0, i1 = self.grid
+        self.nodes_lock.acquire()
+        try:
+            ids, self.dirty = [ id for id in self.dirty if i0 <= id < i1 ], set()
+            if not ids:
+                return
+            self.drawn_norm = self.norm
+            t0 = time.time()
+            dc = wx.MemoryDC(self.buffer)
+            if nw < LOD_WIDTH:
+                rects = [ self.draw_heatmap(dc) ]
+            else:
+                dirty = [ self.nodes[id] for id in ids ]
+                rects = [ (n.x-1, n.y-1, n.w+2, n.h+2) for n in dirty ]
+                dc.DrawRectangleList(rects, self.cache.pens["black"], self.cache.brushes["black"])
+                self.draw_nodes(dc, dirty)
+            dc.SelectObject(wx.NullBitmap)
+            elapsed = time.time() - t0
+            histogram("paint.draw").observe(elapsed)
+            histogram("paint.tile").observe(elapsed / len(ids), len(ids))
+        except Exception, err:
+            print "Exception:MyFrame.draw_dirty():", err
+            return
+        finally:
+            self.nodes_lock.release()
+        for rect in rects:
+            self.RefreshRect(wx.Rect(*rect), False)
+        pass
+
+    def draw_heatmap(self, dc):
+        """Draw the visible rows as one bitmap with a pixel per node, green
+        to red by load and grey if stale, scaled up to the tile size.
+        Highlighted nodes get a frame. Return the rect drawn."""
+        mx, nw, nh, i0, i1 = self.grid
+        rows = int(math.ceil((i1 - i0)/float(mx)))
+        ids = numpy.arange(i0, i0 + rows*mx)
+        valid = ids < i1
+        ids = ids[valid]
+        ratio = self.model.load_ratio()[ids]
+        fresh = self.model.fresh(time.time(), STALE_AGE)[ids]
+        rgb = numpy.zeros((rows*mx, 3), dtype=numpy.uint8)
+        rgb[valid, 0] = numpy.where(fresh, 255*ratio, 96)
+        rgb[valid, 1] = numpy.where(fresh, 255*(1 - ratio), 96)
+        rgb[valid, 2] = numpy.where(fresh, 0, 96)
+        image = wx.EmptyImage(mx, rows)
+        image.SetData(rgb.tostring())
+        w, h = mx*(nw+2), rows*(nh+2)
+        x, y = 2, (i0/mx)*(nh+2) + 2 - self.scroll
+        dc.DrawBitmap(wx.BitmapFromImage(image.Scale(w, h)), x, y)
+        batch = DrawBatch(self.cache)
+        for id in ids:
+            node = self.nodes[id]
+            if node.highlight:
+                batch.add("highlight", "none", (node.x, node.y, node.w, node.h))
+        batch.flush(dc)
+        return (x, y, w, h)
 
     def update_power_consumption(self, event=None):
         self.power_consumption = get_pc_mikko()
@@ -212,14 +383,18 @@ class MyFrame(wx.Frame):
     def btexp(self, event=None):
         args = []
         for node in self.nodes:
-            if node.highlight:
-                args += [str(node.id+1)]
+            m = re.search(r"(\d+)", node.name)
+            if node.highlight and m:
+                args += [str(int(m.group(1)))]
         subprocess.Popen(["./btexp.py"] + args)
         pass
 
-    def draw_nodes(self, dc):
-        for node in self.nodes:
-            node.draw(dc)
+    def draw_nodes(self, dc, nodes):
+        batch = DrawBatch(self.cache)
+        dc.SetFont(self.cache.font)
+        for node in nodes:
+            node.draw(dc, batch)
+        batch.flush(dc)
         pass
 
     def on_left_down(self, event=None):
@@ -229,6 +404,7 @@ class MyFrame(wx.Frame):
     def on_left_up(self, event=None):
         self.highlight_nodes()
         self.anchor0 = None
+        self.draw_dirty()
         self.Refresh(False)
         pass
 
@@ -249,7 +425,7 @@ class MyFrame(wx.Frame):
             x2, y2 = self.anchor1
             x,  y  = min(x1,x2), min(y1,y2)
             w,  h  = abs(x1-x2), abs(y1-y2)
-            dc.SetPen(wx.Pen('red', 3, wx.SHORT_DASH))
+            dc.SetPen(self.cache.pens["select"])
             dc.SetBrush(wx.TRANSPARENT_BRUSH)
             dc.DrawRectangle(x, y, w, h)
         pass
@@ -258,50 +434,52 @@ class MyFrame(wx.Frame):
         if self.anchor0 and self.anchor1:
             x1,y1,x2,y2 = self.anchor0[0],self.anchor0[1],self.anchor1[0],self.anchor1[1]
             rect = (min(x1,x2),min(y1,y2),abs(x1-x2),abs(y1-y2))
-            for node in self.nodes:
+            for node in self.nodes[self.grid[3]:self.grid[4]]:
                 if are_rects_overlapped(rect, (node.x,node.y,node.w,node.h)):
                     node.highlight = not node.highlight
+                    self.mark_dirty([node.id])
         pass
 
     def set_frame_title(self):
-        rr = calc_rate(self.rr_total)
-        tr = calc_rate(self.tr_total)
+        rr_total, tr_total = self.model.totals()
+        rr = calc_rate(rr_total)
+        tr = calc_rate(tr_total)
         self.SetTitle("UKKO CLUSTER  PC: %s W  RX: %s  TX: %s" % (str(self.power_consumption), rr, tr))
         pass
 
     def process_multicast(self):
         while not self.event.isSet():
-            try:
-                data = INCQUE.get()
-                self.nodes_lock.acquire()
-                id = int(re.search(r"(\d+)", data["nodename"]).group(1)) - 1
-                n = self.nodes[id]
-                n.ts = time.time()
-                n.load = float(data["load"])
-                n.cpu_count = float(data["cpu_count"])
-                n.mem_used = float(data["mem_used"])
-                n.mem_total = float(data["mem_total"])
-                n.user_count = int(data["user_count"])
-                #n.user_uniq = int(data["user_uniq"])
-                n.disk = data["disk"]
-                n.rx = data["rx"]
-                n.tx = data["tx"]
-                n.rr = data["rr"]
-                n.tr = data["tr"]
-                self.nodes_lock.release()
-            except Exception, err:
-                self.nodes_lock.release()
-                print "Exception:process_multicast():", err
+            with timer("ingest.run"):
+                self.ingest.run_once(self.nodes_lock, self.apply_stats)
+            self.event.wait(POLL_INTERVAL)
+
+    def apply_stats(self, id, data):
+        """Called by the ingest stage with nodes_lock held."""
+        self.model.update(id, data)
+        self.nodes[id].history.record(data["rr"], data["tr"])
+        self.dirty.add(id)
+        if id not in self.expiring:
+            self.expiring.add(id)
+            heapq.heappush(self.expiry, (data["recv_ts"] + STALE_AGE, id))
     pass
 
 if __name__=="__main__":
+    # Usage: pygui.py [aggregator's host:port or unix socket path]
     app = wx.App()
-    frame = MyFrame(None, "UKKO Cluster", (800,600))
+    client = AggregatorClient(sys.argv[1]) if len(sys.argv) > 1 else None
+    frame = MyFrame(None, "UKKO Cluster", (800,600), client.queue if client else None)
     frame.Show()
-    # Start the multicast listener as daemon
-    listener = Process(target=MyListener(None, 1212, True).listen_forever, args=())
-    listener.daemon = True
-    listener.start()
+    if client:
+        # Attach to a running centermc aggregator
+        t = threading.Thread(target=client.run, args=())
+        t.daemon = True
+        t.start()
+    else:
+        # Start the multicast listener as daemon
+        listener = Process(target=MyListener(MGROUP, 1212, MGROUP is None, table=STATE).listen_forever, args=())
+        listener.daemon = True
+        listener.start()
+    frame.register_metrics()
     # Start the worker thread for processing update multicasts
     t = threading.Thread(target=frame.process_multicast, args=())
     t.daemon = True
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Registration of a unicast listener at the nodes. The nodes forget a
+# listener which has not registered for 800s, and confirm every
+# registration with an ack. A confirmed registration is only renewed
+# REG_REFRESH seconds after its ack, ahead of that expiry; one without an
+# ack is sent again every REG_INTERVAL, backing off up to REG_BACKOFF_MAX
+# for hosts which have never answered. The hosts' addresses are resolved
+# once per DNS_TTL instead of on every send.
+# Old nodes only understand the pickle registration, so it is sent along
+# with the binary one while REG_LEGACY is on.
+#
+
+import os
+import time
+import socket
+from wire import encode_register, dumps_legacy
+
+REG_HOSTS = os.path.expanduser("~/.umon/hosts")   # One host per line
+REG_INTERVAL = 30               # How often stale registrations are looked for
+REG_EXPIRY = 800                # The nodes forget a listener after this
+REG_REFRESH = REG_EXPIRY - 200  # Confirmed registrations are renewed after this
+REG_BACKOFF_MAX = 600           # Max wait between sends to a silent host
+DNS_TTL = 3600                  # How long a resolved address is used
+DNS_NEG_TTL = 300               # How long a failed lookup is not retried
+REG_LEGACY = True               # Also send the pickle registration of old nodes
+
+def load_hosts(path=REG_HOSTS):
+    """The hosts listed in path, or the Ukko nodes if there is no such file."""
+    if os.path.exists(path):
+        lines = [ line.split("#")[0].strip() for line in open(path) ]
+        return [ line for line in lines if line ]
+    return [ "ukko%03i.hpc.cs.helsinki.fi" % i for i in range(1, 256) ]
+
+class Registrar(object):
+    """Keeps the registration of the listener at addr fresh at the hosts
+    and at the nodes discovered from the datagrams arriving."""
+    def __init__(self, addr, hosts=None):
+        self.addr = (socket.gethostbyname(addr[0]), addr[1])
+        self.payloads = [ encode_register(addr) ]
+        if REG_LEGACY:
+            self.payloads.append(dumps_legacy(self.addr))
+        self.hosts = load_hosts() if hosts is None else list(hosts)
+        self.discovered = set()
+        self.dns = {}                    # host -> (ip or None, expiry)
+        self.confirmed = {}              # ip -> time of the last ack
+        self.sent_at = {}                # ip -> time of the last registration
+        self.attempts = {}               # ip -> sends since the last ack
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sent, self.acks, self.lookups = 0, 0, 0
+        pass
+
+    def resolve(self, host, now):
+        entry = self.dns.get(host)
+        if entry and entry[1] > now:
+            return entry[0]
+        self.lookups += 1
+        try:
+            ip, ttl = socket.gethostbyname(host), DNS_TTL
+        except socket.error:
+            ip, ttl = None, DNS_NEG_TTL
+        self.dns[host] = (ip, now + ttl)
+        return ip
+
+    def discover(self, ip):
+        """A node sending to the listener, to be kept registered."""
+        self.discovered.add(ip)
+        pass
+
+    def confirm(self, ip, addr, now):
+        """An ack from the node at ip."""
+        if tuple(addr) == self.addr:
+            self.confirmed[ip] = now
+            self.attempts.pop(ip, None)
+            self.acks += 1
+        pass
+
+    def due(self, ip, now):
+        """True if the registration at ip should be sent now."""
+        confirmed, sent = self.confirmed.get(ip), self.sent_at.get(ip)
+        if sent is None:
+            return True
+        if confirmed is not None and confirmed >= sent:
+            return now - confirmed >= REG_REFRESH
+        # Unconfirmed. A host which has acked before is retried every
+        # REG_INTERVAL so that it does not expire the listener meanwhile.
+        if confirmed is not None:
+            return now - sent >= REG_INTERVAL
+        wait = REG_INTERVAL * 2**max(self.attempts.get(ip, 1) - 1, 0)
+        return now - sent >= min(wait, REG_BACKOFF_MAX)
+
+    def refresh(self, now=None):
+        """Send the registration where it is stale. Return the num sent."""
+        now = now or time.time()
+        targets = set(self.discovered)
+        for host in self.hosts:
+            ip = self.resolve(host, now)
+            if ip:
+                targets.add(ip)
+        sent = 0
+        for ip in targets:
+            if not self.due(ip, now):
+                continue
+            try:
+                for payload in self.payloads:
+                    self.sock.sendto(payload, (ip, self.addr[1]))
+                self.sent_at[ip] = now
+                self.attempts[ip] = self.attempts.get(ip, 0) + 1
+                sent += 1
+            except Exception, err:
+                print "Exception:registration.py:Registrar.refresh():", ip, err
+        self.sent += sent
+        return sent
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception, err:
+                print "Exception:registration.py:Registrar.run():", err
+            time.sleep(REG_INTERVAL)
+        pass
+
+    def counters(self):
+        # A copy, as run() adds hosts while the metrics thread reads
+        sent = list(self.sent_at.keys())
+        return { "sent": self.sent, "acks": self.acks, "lookups": self.lookups,
+                 "confirmed": len(self.confirmed),
+                 "unconfirmed": sum(1 for ip in sent if ip not in self.confirmed) }
+
+    pass
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+#
+# Relay aggregation of the node reports. In relay mode the nodes of a
+# subnet send their frames to the subnet's boss instead of to every
+# listener, and the boss forwards everything received in an interval to
+# the listeners as compressed batch frames of at most wire.BATCH_MAX bytes,
+# which are not fragmented, see wire.encode_batches. A center watching N
+# nodes then handles N/15 or fewer datagrams per interval instead of N,
+# depending on how well the reports compress.
+#
+
+import threading
+from wire import is_legacy, unpack_header, encode_batches, MSG_BATCH
+
+RELAY_PORT = 1214               # UDP port the boss collects the reports on
+RELAY_INTERVAL = 1.0            # How often the collected reports are forwarded
+RELAY_BACKLOG = 4096            # Frames held at most between two flushes
+
+class Relay(object):
+    """Frames collected from the neighbours, flushed as batch frames."""
+    def __init__(self, name, compress=True, backlog=RELAY_BACKLOG):
+        self.name = name
+        self.compress = compress
+        self.backlog = backlog
+        self.frames = []
+        self.lock = threading.Lock()
+        self.frames_in, self.bytes_in, self.rejected, self.dropped = 0, 0, 0, 0
+        self.batches_out, self.bytes_out = 0, 0
+        pass
+
+    def add(self, data):
+        """Hold a frame until the next flush. Pickle frames, which the
+        batches cannot carry, and nested batches are rejected."""
+        if len(data) == 0 or is_legacy(data) or unpack_header(data)[0] == MSG_BATCH:
+            self.rejected += 1
+            return False
+        self.lock.acquire()
+        try:
+            if len(self.frames) >= self.backlog:
+                self.dropped += 1
+                return False
+            self.frames.append(data)
+            self.frames_in += 1
+            self.bytes_in += len(data)
+        finally:
+            self.lock.release()
+        return True
+
+    def flush(self):
+        """The batch frames to forward, in the order the frames arrived."""
+        self.lock.acquire()
+        frames, self.frames = self.frames, []
+        self.lock.release()
+        if not frames:
+            return []
+        batches = encode_batches(self.name, frames, self.compress)
+        self.batches_out += len(batches)
+        self.bytes_out += sum(len(b) for b in batches)
+        return batches
+
+    def counters(self):
+        return { "frames_in": self.frames_in, "bytes_in": self.bytes_in,
+                 "batches_out": self.batches_out, "bytes_out": self.bytes_out,
+                 "rejected": self.rejected, "dropped": self.dropped,
+                 "packet_reduction": self.frames_in / float(max(self.batches_out, 1)),
+                 "byte_reduction": self.bytes_in / float(max(self.bytes_out, 1)) }
+
+    pass
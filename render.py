@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Batched drawing for pygui and btexp. The tiles do not draw their bars one
+# rectangle at a time; they add NumPy coordinate arrays to a DrawBatch, and
+# the batch issues one DrawRectangleList per pen and brush for the whole
+# frame. Fonts, pens and brushes live in a DrawCache and are only rebuilt
+# when the font size changes on resize.
+#
+
+import wx
+import numpy
+
+def bar_rects(values, x, y, w, h, r, norm, shift=0):
+    """The rectangles of a speed curve, the newest sample at the right edge.
+    Same geometry as drawing values[-i] at x+w-i*r for i in 1..len-1."""
+    n = len(values)
+    if n < 2:
+        return numpy.zeros((0, 4), dtype=numpy.int32)
+    i = numpy.arange(1, n)
+    hgt = (h * numpy.asarray(values)[:0:-1] / norm).astype(numpy.int32)
+    rects = numpy.empty((n - 1, 4), dtype=numpy.int32)
+    rects[:,0] = x + w - i*r - shift
+    rects[:,1] = y + h - hgt
+    rects[:,2] = r - 1
+    rects[:,3] = hgt
+    return rects
+
+class DrawCache(object):
+    """Fonts, pens and brushes shared by all the tiles."""
+    def __init__(self):
+        self.fz = None
+        self.font = None
+        self.pens = { "none": wx.Pen("cyan", 0, wx.TRANSPARENT),
+                      "frame": wx.Pen(wx.Colour(64,64,64), 1),
+                      "grey": wx.Pen('grey', 1),
+                      "highlight": wx.Pen('red', 2),
+                      "black": wx.Pen('black', 0),
+                      "select": wx.Pen('red', 3, wx.SHORT_DASH) }
+        self.brushes = { "none": wx.TRANSPARENT_BRUSH,
+                         "black": wx.BLACK_BRUSH,
+                         "green": wx.GREEN_BRUSH,
+                         "red": wx.RED_BRUSH,
+                         "blue": wx.Brush(wx.Colour(0,0,255), wx.SOLID) }
+        pass
+
+    def rebuild(self, fz):
+        """Rebuild the font for a new font size, a no-op if unchanged."""
+        fz = max(int(fz), 1)
+        if fz != self.fz:
+            self.fz = fz
+            self.font = wx.Font(fz, wx.FONTFAMILY_SWISS, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL)
+        pass
+
+    pass
+
+class DrawBatch(object):
+    """Rectangles collected per (pen, brush) during a paint."""
+    def __init__(self, cache):
+        self.cache = cache
+        self.order = []
+        self.rects = {}
+        pass
+
+    def add(self, pen, brush, rects):
+        """Add an (n, 4) array or a list of (x, y, w, h) rectangles."""
+        key = (pen, brush)
+        if key not in self.rects:
+            self.order.append(key)
+            self.rects[key] = []
+        self.rects[key].append(numpy.asarray(rects, dtype=numpy.int32).reshape(-1, 4))
+        pass
+
+    def flush(self, dc):
+        for key in self.order:
+            rects = numpy.concatenate(self.rects[key])
+            if len(rects):
+                pen, brush = key
+                dc.DrawRectangleList(rects.tolist(), self.cache.pens[pen], self.cache.brushes[brush])
+        self.order = []
+        self.rects = {}
+        pass
+
+    pass
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+#
+# High-frequency sampling of the cheap counters of a node. A thread reads
+# the interface's byte counters and the CPU times at 10-50Hz into ring
+# buffers, and every report carries the min/max/p50/p95 of the samples
+# taken since the previous report, so that short bursts are not averaged
+# away by the once-per-interval rates. The CPU time spent sampling is
+# measured and the rate is lowered whenever it exceeds CPU_BUDGET.
+#
+
+import math
+import time
+import threading
+from array import array
+from collector import ProcFile
+
+SAMPLE_HZ = 20                  # Preferred sampling rate
+MIN_HZ, MAX_HZ = 1, 50
+CPU_BUDGET = 0.01               # Fraction of one core the sampler may use
+RING_LEN = 1024                 # Samples kept per series
+ADJUST_EVERY = 5.0              # Seconds between rate adjustments
+
+SERIES = ("rr", "tr", "cpu")    # Bytes/s, bytes/s, permille of all cores
+
+class Ring(object):
+    """Fixed-size ring buffer of floats, indexed by the total num of
+    values appended so far."""
+    def __init__(self, size=RING_LEN):
+        self.size = size
+        self.buf = array("d", [0.0] * size)
+        self.count = 0
+        pass
+
+    def append(self, v):
+        self.buf[self.count % self.size] = v
+        self.count += 1
+        pass
+
+    def since(self, start):
+        """The values appended since count was start, at most size of them."""
+        start = max(start, self.count - self.size)
+        return [ self.buf[i % self.size] for i in range(start, self.count) ]
+
+    pass
+
+def percentile(values, p):
+    """The nearest-rank percentile of sorted values."""
+    return values[max(int(math.ceil(p/100.0*len(values))) - 1, 0)]
+
+class Sampler(threading.Thread):
+    """Samples eth's traffic and the CPU usage in the background."""
+    def __init__(self, eth, hz=SAMPLE_HZ, budget=CPU_BUDGET):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.eth = eth
+        self.target_hz = self.hz = hz
+        self.budget = budget
+        self.net = ProcFile("/proc/net/dev")
+        self.stat = ProcFile("/proc/stat")
+        self.rings = dict((k, Ring()) for k in SERIES)
+        self.reported = 0                # Ring count at the last summary
+        self.last = None                 # (t, rx, tx, busy, total) of the last sample
+        self.cost = 0.0                  # CPU seconds spent sampling since the last adjustment
+        self.load = 0.0                  # Fraction of a core used recently
+        self.adjusted = time.time()      # Time of the last rate adjustment
+        self.lock = threading.Lock()
+        pass
+
+    def read_counters(self):
+        rx, tx = 0, 0
+        for line in self.net.read().splitlines()[2:]:
+            name, _, fields = line.partition(":")
+            if name.strip() == self.eth:
+                fields = fields.split()
+                rx, tx = int(fields[0]), int(fields[8])
+                break
+        cpu = [ int(x) for x in self.stat.read().split("\n", 1)[0].split()[1:] ]
+        total = sum(cpu)
+        return rx, tx, total - cpu[3] - (cpu[4] if len(cpu) > 4 else 0), total
+
+    def sample(self):
+        t = time.time()
+        rx, tx, busy, total = self.read_counters()
+        if self.last:
+            t0, rx0, tx0, busy0, total0 = self.last
+            dt = max(t - t0, 1e-3)
+            self.lock.acquire()
+            self.rings["rr"].append(max(rx - rx0, 0) / dt)
+            self.rings["tr"].append(max(tx - tx0, 0) / dt)
+            self.rings["cpu"].append(1000.0 * (busy - busy0) / max(total - total0, 1))
+            self.lock.release()
+        self.last = (t, rx, tx, busy, total)
+        pass
+
+    def step(self):
+        """Take one sample, and adjust the rate every ADJUST_EVERY seconds.
+        Called by run(), or every 1/hz seconds by an event loop."""
+        # Process CPU time, so that waiting for the CPU or for the reads on a
+        # loaded host is not taken for the sampler's own cost
+        start = time.clock()
+        try:
+            self.sample()
+        except Exception, err:
+            print "Exception:sampler.py:Sampler.step():", err
+        self.cost += time.clock() - start
+        now = time.time()
+        if now - self.adjusted >= ADJUST_EVERY:
+            self.adjust(now - self.adjusted)
+            self.adjusted = now
+        pass
+
+    def run(self):
+        next_t = time.time()
+        while True:
+            self.step()
+            now = time.time()
+            next_t = max(next_t + 1.0/self.hz, now)
+            time.sleep(max(next_t - now, 0))
+        pass
+
+    def adjust(self, elapsed):
+        """Halve the rate if the sampler used more than its budget, and
+        double it back towards the preferred rate when well below it."""
+        self.load = self.cost / elapsed
+        self.cost = 0.0
+        if self.load > self.budget and self.hz > MIN_HZ:
+            self.hz = max(self.hz / 2.0, MIN_HZ)
+        elif self.load < self.budget / 4 and self.hz < self.target_hz:
+            self.hz = min(self.hz * 2, self.target_hz, MAX_HZ)
+        pass
+
+    def summary(self):
+        """{series_min, _max, _p50, _p95} of the samples since the last
+        call, or {} if there are none."""
+        self.lock.acquire()
+        try:
+            start = self.reported
+            self.reported = self.rings["rr"].count
+            series = dict((k, sorted(r.since(start))) for k, r in self.rings.items())
+        finally:
+            self.lock.release()
+        summary = {}
+        for k, values in series.iteritems():
+            if not values:
+                return {}
+            summary[k + "_min"] = int(values[0])
+            summary[k + "_max"] = int(values[-1])
+            summary[k + "_p50"] = int(percentile(values, 50))
+            summary[k + "_p95"] = int(percentile(values, 95))
+        return summary
+
+    def counters(self):
+        return { "hz": self.hz, "load": self.load, "samples": self.rings["rr"].count }
+
+    pass
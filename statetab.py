@@ -0,0 +1,101 @@
+#!/usr/bin/python
+#
+# Shared-memory table of the latest metrics of every node. The listener
+# process writes each node frame straight into a fixed slot of an anonymous
+# shared mmap, and the GUI reads the slots back without any serialization.
+# Every slot is guarded by a seqlock: the writer bumps the slot's sequence
+# number to an odd value before writing and to the next even value after,
+# and a reader retries until it sees the same even number on both sides.
+#
+
+import mmap
+import struct
+from wire import NODE_FIELDS, SUMMARY_FIELDS, node_stats
+
+SLOTS = 16384
+NAME_LEN = 63
+TABLE_HEADER = struct.Struct("=I")            # num of slots in use
+SLOT_SEQ = struct.Struct("=I")
+SLOT_RECORD = struct.Struct("=d" + "".join(c for _, c in NODE_FIELDS) +
+                            "B" + "".join(c for _, c in SUMMARY_FIELDS) + "B%is" % NAME_LEN)
+
+class StateTable(object):
+    """Fixed-slot table of node records. There must be only one writer,
+    the listener process, but any number of readers. The table has to be
+    created before the processes are forked."""
+    def __init__(self, slots=SLOTS):
+        self.slots = slots
+        self.slot_len = SLOT_SEQ.size + SLOT_RECORD.size
+        self.mm = mmap.mmap(-1, TABLE_HEADER.size + slots*self.slot_len)
+        self.index = {}                # nodename -> slot, writer side only
+        self.overflow = 0
+        pass
+
+    def offset(self, slot):
+        return TABLE_HEADER.size + slot*self.slot_len
+
+    def used(self):
+        return TABLE_HEADER.unpack_from(self.mm, 0)[0]
+
+    def seq(self, slot):
+        return SLOT_SEQ.unpack_from(self.mm, self.offset(slot))[0]
+
+    def write(self, stats, recv_ts):
+        """Store a node's stats in its slot, allocating one for a new node."""
+        name = stats["nodename"][:NAME_LEN]
+        # Before the slot is marked as being written, so a bad record
+        # cannot leave it odd for good
+        values = [ stats[k] for k, _ in NODE_FIELDS ]
+        values.append("rr_p95" in stats)
+        values.extend(stats.get(k, 0) for k, _ in SUMMARY_FIELDS)
+        record = SLOT_RECORD.pack(recv_ts, *(values + [len(name), name]))
+        slot = self.index.get(name)
+        if slot is None:
+            slot = self.used()
+            if slot >= self.slots:
+                self.overflow += 1
+                return None
+            self.index[name] = slot
+            TABLE_HEADER.pack_into(self.mm, 0, slot + 1)
+        off = self.offset(slot)
+        seq = SLOT_SEQ.unpack_from(self.mm, off)[0]
+        SLOT_SEQ.pack_into(self.mm, off, seq + 1)
+        self.mm[off + SLOT_SEQ.size:off + SLOT_SEQ.size + len(record)] = record
+        SLOT_SEQ.pack_into(self.mm, off, seq + 2)
+        return slot
+
+    def read(self, slot):
+        """Return (seq, stats) of a slot, a consistent snapshot of it."""
+        off = self.offset(slot)
+        while True:
+            seq0 = SLOT_SEQ.unpack_from(self.mm, off)[0]
+            if seq0 & 1:
+                continue
+            record = SLOT_RECORD.unpack_from(self.mm, off + SLOT_SEQ.size)
+            if SLOT_SEQ.unpack_from(self.mm, off)[0] == seq0:
+                break
+        n, name = record[-2], record[-1]
+        nf, ns = len(NODE_FIELDS), len(SUMMARY_FIELDS)
+        stats = node_stats(name[:n], record[1:1+nf])
+        if record[1+nf]:
+            stats.update(zip([ k for k, _ in SUMMARY_FIELDS ], record[2+nf:2+nf+ns]))
+        stats["recv_ts"] = record[0]
+        return seq0, stats
+
+    def changed(self, versions):
+        """Return [(slot, stats)] of the slots written since the reader's
+        last call. versions is the reader's list of seen sequence numbers
+        and is updated in place."""
+        updates = []
+        used = self.used()
+        if len(versions) < used:
+            versions.extend([0] * (used - len(versions)))
+        for slot in range(used):
+            if self.seq(slot) != versions[slot]:
+                seq, stats = self.read(slot)
+                if seq:
+                    versions[slot] = seq
+                    updates.append((slot, stats))
+        return updates
+
+    pass
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+#
+# Persistent time-series store of the node samples seen by centermc. Every
+# level (raw samples and the 1s/1m/1h rollups) is an append-only columnar
+# store partitioned by time: a directory per partition holding one
+# memory-mapped file per column. Rows are appended in time order, so a
+# range query only maps the partitions overlapping the range and binary
+# searches their ts column, without reading the rest into RAM. Partitions
+# older than their level's retention are deleted.
+#
+
+import os
+import time
+import shutil
+import numpy
+
+TSDB_PATH = os.path.expanduser("~/.umon/tsdb")
+METRICS = ["load", "cpu_count", "mem_used", "mem_total", "rr", "tr"]
+INITIAL_ROWS = 2**14
+MAX_POINTS = 2000               # Finest level whose num of points fits is used
+
+#          name   resolution  partition span  retention
+LEVELS = [ ("raw",    0,      3600,           2*86400),
+           ("1s",     1,      3600,           7*86400),
+           ("1m",    60,      86400,          90*86400),
+           ("1h",  3600,      30*86400,       5*365*86400) ]
+
+class Partition(object):
+    """The memory-mapped columns of one time partition of a level."""
+    def __init__(self, path, columns, readonly=False):
+        self.path = path
+        self.columns = columns
+        self.readonly = readonly
+        if not readonly and not os.path.isdir(path):
+            os.makedirs(path)
+        self.rows = numpy.memmap(os.path.join(path, "rows"), dtype=numpy.int64,
+                                 mode=self.mode("rows"), shape=(1,))
+        self.cols = {}
+        capacity = INITIAL_ROWS
+        for name, dtype in columns:
+            fn = os.path.join(path, name)
+            if os.path.exists(fn):
+                capacity = os.path.getsize(fn) / numpy.dtype(dtype).itemsize
+            self.cols[name] = numpy.memmap(fn, dtype=dtype, mode=self.mode(name), shape=(capacity,))
+        self.capacity = capacity
+        pass
+
+    def mode(self, name):
+        if self.readonly:
+            return "r"
+        return "r+" if os.path.exists(os.path.join(self.path, name)) else "w+"
+
+    def __len__(self):
+        return int(self.rows[0])
+
+    def grow(self):
+        capacity = self.capacity * 2
+        for name, dtype in self.columns:
+            self.cols[name].flush()
+            del self.cols[name]
+            fn = os.path.join(self.path, name)
+            f = open(fn, "r+b")
+            f.truncate(capacity * numpy.dtype(dtype).itemsize)
+            f.close()
+            self.cols[name] = numpy.memmap(fn, dtype=dtype, mode="r+", shape=(capacity,))
+        self.capacity = capacity
+        pass
+
+    def append(self, row):
+        n = len(self)
+        if n == self.capacity:
+            self.grow()
+        for name, _ in self.columns:
+            self.cols[name][n] = row[name]
+        self.rows[0] = n + 1
+        pass
+
+    def select(self, node, t0, t1, names):
+        """The rows of a node with t0 <= ts < t1, as {column: array}."""
+        n = len(self)
+        ts = self.cols["ts"][:n]
+        i0, i1 = numpy.searchsorted(ts, [t0, t1])
+        mask = self.cols["node"][i0:i1] == node
+        return dict((name, numpy.array(self.cols[name][i0:i1][mask])) for name in names)
+
+    def flush(self):
+        self.rows.flush()
+        for col in self.cols.values():
+            col.flush()
+        pass
+
+    pass
+
+class Level(object):
+    """Raw samples or one rollup resolution, partitioned by time."""
+    def __init__(self, root, name, resolution, span, retention, columns):
+        self.path = os.path.join(root, name)
+        self.name = name
+        self.resolution = resolution
+        self.span = span
+        self.retention = retention
+        self.columns = columns
+        self.current = None            # (start, Partition) being appended to
+        self.last_ts = 0.0
+        pass
+
+    def start_of(self, ts):
+        return int(ts // self.span * self.span)
+
+    def append(self, row):
+        row["ts"] = max(row["ts"], self.last_ts)
+        self.last_ts = row["ts"]
+        start = self.start_of(row["ts"])
+        if self.current is None or self.current[0] != start:
+            if self.current:
+                self.current[1].flush()
+            self.current = (start, Partition(os.path.join(self.path, str(start)), self.columns))
+            self.evict(row["ts"])
+        self.current[1].append(row)
+        pass
+
+    def query(self, node, t0, t1, names):
+        parts = []
+        for start in range(self.start_of(t0), int(t1) + 1, self.span):
+            path = os.path.join(self.path, str(start))
+            if self.current and self.current[0] == start:
+                parts.append(self.current[1].select(node, t0, t1, names))
+            elif os.path.isdir(path):
+                parts.append(Partition(path, self.columns, True).select(node, t0, t1, names))
+        if not parts:
+            return dict((name, numpy.zeros(0, dtype=dict(self.columns)[name])) for name in names)
+        return dict((name, numpy.concatenate([ p[name] for p in parts ])) for name in names)
+
+    def evict(self, now):
+        """Delete the partitions which ended more than retention ago."""
+        if not os.path.isdir(self.path):
+            return
+        for start in os.listdir(self.path):
+            if start.isdigit() and int(start) + self.span < now - self.retention:
+                shutil.rmtree(os.path.join(self.path, start), True)
+        pass
+
+    def flush(self):
+        if self.current:
+            self.current[1].flush()
+        pass
+
+    pass
+
+class Rollup(object):
+    """Accumulates min/max/sum per node for the bucket in progress, and
+    writes the rows of all the nodes once a later bucket starts, so that
+    the rows of a level stay in time order."""
+    def __init__(self, level):
+        self.level = level
+        self.bucket = None
+        self.acc = {}                  # node -> [count, mins, maxs, sums]
+        pass
+
+    def add(self, node, ts, values):
+        bucket = int(ts // self.level.resolution * self.level.resolution)
+        if self.bucket is not None and bucket > self.bucket:
+            self.flush()
+        self.bucket = bucket if self.bucket is None else max(bucket, self.bucket)
+        acc = self.acc.get(node)
+        if acc is None:
+            self.acc[node] = [1, list(values), list(values), list(values)]
+        else:
+            acc[0] += 1
+            for i, v in enumerate(values):
+                acc[1][i] = min(acc[1][i], v)
+                acc[2][i] = max(acc[2][i], v)
+                acc[3][i] += v
+        pass
+
+    def flush(self):
+        for node, (count, mins, maxs, sums) in sorted(self.acc.items()):
+            row = { "ts": self.bucket, "node": node }
+            for i, m in enumerate(METRICS):
+                row[m + ".min"] = mins[i]
+                row[m + ".max"] = maxs[i]
+                row[m + ".mean"] = sums[i] / count
+            self.level.append(row)
+        self.acc = {}
+        pass
+
+    pass
+
+class Store(object):
+    """The time-series store. append() takes the stats dicts decoded by the
+    listener, query() returns numpy arrays of one node over a time range."""
+    def __init__(self, root=TSDB_PATH):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.names_path = os.path.join(root, "nodes")
+        self.nodes = {}
+        if os.path.exists(self.names_path):
+            for i, name in enumerate(open(self.names_path).read().split()):
+                self.nodes[name] = i
+        self.names_file = open(self.names_path, "a")
+        raw_columns = [ ("ts", numpy.float64), ("node", numpy.uint16) ] + \
+                      [ (m, numpy.float32) for m in METRICS ]
+        rollup_columns = [ ("ts", numpy.float64), ("node", numpy.uint16) ] + \
+                         [ (m + "." + f, numpy.float32) for m in METRICS for f in ("min", "max", "mean") ]
+        self.levels = []
+        for name, resolution, span, retention in LEVELS:
+            columns = rollup_columns if resolution else raw_columns
+            self.levels.append(Level(root, name, resolution, span, retention, columns))
+        self.rollups = [ Rollup(level) for level in self.levels if level.resolution ]
+        pass
+
+    def node_id(self, name):
+        id = self.nodes.get(name)
+        if id is None:
+            id = self.nodes[name] = len(self.nodes)
+            self.names_file.write(name + "\n")
+            self.names_file.flush()
+        return id
+
+    def append(self, stats):
+        node = self.node_id(stats["nodename"])
+        ts = stats.get("recv_ts", time.time())
+        values = [ float(stats[m]) for m in METRICS ]
+        row = dict(zip(METRICS, values))
+        row["ts"] = ts
+        row["node"] = node
+        self.levels[0].append(row)
+        for rollup in self.rollups:
+            rollup.add(node, ts, values)
+        pass
+
+    def level(self, t0, t1, level=None):
+        """The named level, or the finest one with at most MAX_POINTS."""
+        if level is not None:
+            return [ l for l in self.levels if l.name == level ][0]
+        for l in self.levels:
+            if (t1 - t0) / max(l.resolution, 1) <= MAX_POINTS:
+                return l
+        return self.levels[-1]
+
+    def query(self, nodename, t0, t1, metric=None, level=None):
+        """Return {column: array} of a node for t0 <= ts < t1. metric limits
+        the columns to one metric; the level is picked from the range unless
+        given ("raw", "1s", "1m" or "1h")."""
+        l = self.level(t0, t1, level)
+        if nodename not in self.nodes:
+            names = [ c for c, _ in l.columns ]
+            return dict((c, numpy.zeros(0)) for c in names)
+        names = [ c for c, _ in l.columns if metric is None or c == "ts" or c.split(".")[0] == metric ]
+        return l.query(self.nodes[nodename], t0, t1, names)
+
+    def flush(self):
+        for l in self.levels:
+            l.flush()
+        pass
+
+    pass
@@ -0,0 +1,405 @@
+#!/usr/bin/python
+#
+# Compact binary wire format between nodemc and centermc. Every frame starts
+# with a fixed header (magic, version, message type, flags) followed by the
+# sender's name, so that a receiver can route or drop a frame before decoding
+# the body. Bodies are fixed-layout struct records with numeric fields.
+#
+# Node frames can optionally be sent as deltas: the body then starts with a
+# bit mask of the fields present, and absent fields keep their value in the
+# base frame. A full frame, the keyframe, is sent every KEYFRAME frames. In
+# version 2 deltas are against the last keyframe, whose sequence number
+# follows the mask, so a lost delta does not corrupt the ones after it, and
+# deltas whose keyframe was lost are dropped instead of being applied to
+# another base. Version 1 deltas were against the previous frame.
+#
+# A node frame with FLAG_SUMMARY set is followed by the min/max/p50/p95 of
+# the high-frequency samples taken since the previous frame.
+#
+# In version 2 node and heartbeat frames carry the sender's sequence number
+# right after the header, so that the listener can account for loss and
+# reordering. Version 1 frames, without it, are still accepted.
+#
+# A heartbeat frame says that the node is alive and its metrics have not
+# changed significantly; the decoder turns it back into the sender's last
+# node record with the heartbeat's timestamp.
+#
+# A batch frame carries the frames of many nodes, forwarded by a relay, as
+# length-prefixed entries, zlib-compressed if FLAG_ZLIB is set. The entries
+# keep their own senders' headers, so Decoder.decode_all() returns the same
+# messages as if they had been received one by one.
+#
+# Old pickle frames are still accepted while LEGACY is on, but they are
+# unpickled without access to any globals so that no code is run. During
+# an upgrade nodes keep sending them (nodemc.py --pickle) until every
+# center decodes the binary frames, and the centers register with both.
+#
+
+import socket
+import zlib
+import struct
+import cPickle
+import cStringIO
+from collector import human_bytes
+
+MAGIC = "UM"
+VERSION = 2
+VERSIONS = (1, 2)               # Versions accepted
+LEGACY = True
+KEYFRAME = 30
+
+MSG_NODE = 1
+MSG_PEER = 2
+MSG_REG = 3
+MSG_REG_ACK = 4
+MSG_HEARTBEAT = 5
+MSG_BATCH = 6
+
+FLAG_DELTA = 0x01
+FLAG_SUMMARY = 0x02
+FLAG_ZLIB = 0x04
+
+HEADER = struct.Struct("!2sBBBB")    # magic, version, type, flags, len(name)
+SEQ = struct.Struct("!I")            # sequence number of v2 node and heartbeat frames
+
+NODE_FIELDS = [ ("timestamp", "d"), ("load", "f"), ("cpu_count", "H"),
+                ("mem_total", "I"), ("mem_used", "I"), ("user_count", "H"),
+                ("disk_pct", "B"), ("rx_bytes", "Q"), ("tx_bytes", "Q"),
+                ("rr", "I"), ("tr", "I") ]
+NODE_BODY = struct.Struct("!" + "".join(c for _, c in NODE_FIELDS))
+NODE_FIELD_STRUCTS = [ (k, struct.Struct("!" + c)) for k, c in NODE_FIELDS ]
+DELTA_MASK = struct.Struct("!H")
+DELTA_BASE = struct.Struct("!I")     # seq of the keyframe of a v2 delta
+SUMMARY_FIELDS = [ (k + "_" + s, c) for k, c in (("rr", "I"), ("tr", "I"), ("cpu", "H"))
+                   for s in ("min", "max", "p50", "p95") ]
+SUMMARY_BODY = struct.Struct("!" + "".join(c for _, c in SUMMARY_FIELDS))
+
+PEER_BODY = struct.Struct("!IIIQQIIB")   # ac, uc, tc, ul/dl size, ul/dl rate, fw|fr
+REG_BODY = struct.Struct("!4sH")
+HEARTBEAT_BODY = struct.Struct("!d")    # timestamp
+BATCH_ENTRY = struct.Struct("!H")       # len(frame)
+BATCH_MAX = 1400                        # Max size of a batch frame, within a path MTU
+
+class WireError(Exception):
+    pass
+
+def pack_header(mtype, name, flags=0, version=VERSION):
+    return HEADER.pack(MAGIC, version, mtype, flags, len(name)) + name
+
+def unpack_header(data):
+    """Return (type, flags, name, offset of the body) of a binary frame."""
+    if len(data) < HEADER.size:
+        raise WireError("short frame")
+    magic, version, mtype, flags, n = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise WireError("bad magic")
+    if version not in VERSIONS:
+        raise WireError("unsupported version %i" % version)
+    off = HEADER.size + n
+    return mtype, flags, data[HEADER.size:off], off
+
+def frame_version(data):
+    return ord(data[2])
+
+def has_seq(mtype, version):
+    return version >= 2 and mtype in (MSG_NODE, MSG_HEARTBEAT)
+
+def is_legacy(data):
+    return data[:2] != MAGIC
+
+def frame_name(data):
+    """The sender's name from the header of a frame in any buffer, or None
+    for a pickle or batch frame, which have no single sender."""
+    if is_legacy(data) or len(data) < HEADER.size:
+        return None
+    magic, version, mtype, flags, n = HEADER.unpack_from(data)
+    if mtype == MSG_BATCH:
+        return None
+    return memoryview(data)[HEADER.size:HEADER.size+n].tobytes()
+
+def loads_legacy(data):
+    """Unpickle an old frame, refusing every global (classes, functions)."""
+    if not LEGACY:
+        raise WireError("legacy pickle frames are disabled")
+    u = cPickle.Unpickler(cStringIO.StringIO(data.strip()))
+    u.find_global = None
+    return u.load()
+
+def legacy_node(stats):
+    """An old pickle node report, with string values and without the
+    rx_bytes, tx_bytes and disk_pct fields, as the stats of a binary node
+    frame. Missing or unparsable fields are 0."""
+    values = []
+    for k, c in NODE_FIELDS:
+        v = stats.get(k, 0)
+        if k == "disk_pct" and k not in stats:
+            v = str(stats.get("disk", "0")).rstrip("%")
+        try:
+            v = float(v) if c in "df" else max(int(float(v)), 0)
+        except (TypeError, ValueError):
+            v = 0.0 if c in "df" else 0
+        values.append(v)
+    node = node_stats(str(stats.get("nodename", "")), values)
+    for k in ("rx", "tx"):
+        if isinstance(stats.get(k), str):
+            node[k] = stats[k]
+    return node
+
+def dumps_legacy(obj):
+    """An old pickle frame, for the hosts not upgraded yet."""
+    return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+def node_values(stats):
+    """The numeric node record in NODE_FIELDS order."""
+    disk = stats.get("disk_pct")
+    if disk is None:
+        disk = int(str(stats.get("disk", "0")).rstrip("%") or 0)
+    values = []
+    for k, c in NODE_FIELDS:
+        v = disk if k == "disk_pct" else stats.get(k, 0)
+        values.append(float(v) if c in "df" else max(int(v), 0))
+    return values
+
+def node_stats(name, values):
+    """Turn a numeric node record back into the stats dict of report_stats."""
+    stats = dict(zip([ k for k, _ in NODE_FIELDS ], values))
+    stats["type"] = "node"
+    stats["nodename"] = name
+    stats["disk"] = "%i%%" % stats["disk_pct"]
+    stats["rx"] = human_bytes(stats["rx_bytes"])
+    stats["tx"] = human_bytes(stats["tx_bytes"])
+    return stats
+
+def encode_summary(stats):
+    """The summary trailer of a node frame, or "" if stats has none."""
+    if "rr_p95" not in stats:
+        return ""
+    return SUMMARY_BODY.pack(*[ max(int(stats[k]), 0) for k, _ in SUMMARY_FIELDS ])
+
+def encode_heartbeat(stats, seq=0):
+    return pack_header(MSG_HEARTBEAT, stats["nodename"]) + SEQ.pack(seq) + HEARTBEAT_BODY.pack(stats["timestamp"])
+
+def encode_node(stats):
+    """A full node frame, independent of any previous frame."""
+    summary = encode_summary(stats)
+    return pack_header(MSG_NODE, stats["nodename"], FLAG_SUMMARY if summary else 0) + \
+           SEQ.pack(stats.get("seq", 0)) + NODE_BODY.pack(*node_values(stats)) + summary
+
+class Encoder(object):
+    """Encode the node's stats, optionally as deltas against the last
+    keyframe. Every frame gets the next sequence number."""
+    def __init__(self, delta=False, keyframe=KEYFRAME):
+        self.delta = delta
+        self.keyframe = keyframe
+        self.count = 0
+        self.seq = 0
+        self.key = None                  # Packed fields of the last keyframe
+        self.key_seq = 0
+        pass
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xffffffff
+        return SEQ.pack(self.seq)
+
+    def heartbeat(self, stats):
+        self.next_seq()
+        return encode_heartbeat(stats, self.seq)
+
+    def encode(self, stats):
+        name = stats["nodename"]
+        values = node_values(stats)
+        packed = [ s.pack(v) for (_, s), v in zip(NODE_FIELD_STRUCTS, values) ]
+        summary = encode_summary(stats)
+        flags = FLAG_SUMMARY if summary else 0
+        full = not self.delta or self.key is None or self.count % self.keyframe == 0
+        self.count += 1
+        if full:
+            data = pack_header(MSG_NODE, name, flags) + self.next_seq() + "".join(packed) + summary
+            self.key, self.key_seq = packed, self.seq
+        else:
+            mask, body = 0, []
+            for i, p in enumerate(packed):
+                if p != self.key[i]:
+                    mask |= 1 << i
+                    body.append(p)
+            data = pack_header(MSG_NODE, name, flags | FLAG_DELTA) + self.next_seq() + \
+                   DELTA_MASK.pack(mask) + DELTA_BASE.pack(self.key_seq) + "".join(body) + summary
+        return data
+
+    pass
+
+class Decoder(object):
+    """Decode frames from many senders. The last node record of every sender
+    and its last keyframe are remembered to resolve heartbeats and deltas."""
+    def __init__(self):
+        self.last = {}
+        self.keys = {}                   # name -> (seq, values) of the last keyframe
+        self.dropped = 0                 # Deltas whose keyframe was lost
+        pass
+
+    def decode(self, data):
+        if is_legacy(data):
+            msg = loads_legacy(data)
+            if isinstance(msg, dict) and msg.get("type") == "node":
+                return legacy_node(msg)
+            return msg
+        mtype, flags, name, off = unpack_header(data)
+        if mtype == MSG_BATCH:
+            raise WireError("batch frame from %s, use decode_all()" % name)
+        if has_seq(mtype, frame_version(data)):
+            seq = SEQ.unpack_from(data, off)[0]
+            stats = self.decode_node(name, flags, data, off + SEQ.size, seq) if mtype == MSG_NODE else \
+                    self.decode_heartbeat(name, data, off + SEQ.size)
+            stats["seq"] = seq
+            return stats
+        if mtype == MSG_NODE:
+            return self.decode_node(name, flags, data, off)
+        elif mtype == MSG_PEER:
+            return decode_peer(name, data, off)
+        elif mtype == MSG_REG:
+            return decode_register(data)
+        elif mtype == MSG_REG_ACK:
+            return decode_register_ack(name, data, off)
+        elif mtype == MSG_HEARTBEAT:
+            return self.decode_heartbeat(name, data, off)
+        raise WireError("unknown message type %i" % mtype)
+
+    def decode_all(self, data, accept=None):
+        """The messages of a frame, many if it is a batch frame. If accept
+        is given, the frames whose sender's name it rejects are skipped
+        without decoding their bodies."""
+        if not is_legacy(data) and unpack_header(data)[0] == MSG_BATCH:
+            return [ self.decode(frame) for frame in unpack_batch(data)
+                     if accept is None or accept(frame_name(frame)) ]
+        if accept is not None and not accept(frame_name(data)):
+            return []
+        return [ self.decode(data) ]
+
+    def decode_node(self, name, flags, data, off, seq=None):
+        """seq is None for version 1 frames, whose deltas are against the
+        previous frame instead of a keyframe."""
+        if flags & FLAG_DELTA:
+            mask = DELTA_MASK.unpack_from(data, off)[0]
+            off += DELTA_MASK.size
+            if seq is None:
+                base = self.last.get(name)
+            else:
+                key_seq = DELTA_BASE.unpack_from(data, off)[0]
+                off += DELTA_BASE.size
+                key = self.keys.get(name)
+                base = key[1] if key and key[0] == key_seq else None
+            if base is None:
+                self.dropped += 1
+                raise WireError("delta frame from %s without its base frame" % name)
+            values = list(base)
+            for i, (_, s) in enumerate(NODE_FIELD_STRUCTS):
+                if mask & (1 << i):
+                    values[i] = s.unpack_from(data, off)[0]
+                    off += s.size
+        else:
+            values = NODE_BODY.unpack_from(data, off)
+            off += NODE_BODY.size
+            if seq is not None:
+                self.keys[name] = (seq, values)
+        self.last[name] = values
+        stats = node_stats(name, values)
+        if flags & FLAG_SUMMARY:
+            stats.update(zip([ k for k, _ in SUMMARY_FIELDS ], SUMMARY_BODY.unpack_from(data, off)))
+        return stats
+
+    def decode_heartbeat(self, name, data, off):
+        """The sender's last node record, or only its liveness if no node
+        frame has been seen from it yet."""
+        ts = HEARTBEAT_BODY.unpack_from(data, off)[0]
+        base = self.last.get(name)
+        if base is None:
+            return { "type": "heartbeat", "nodename": name, "timestamp": ts }
+        values = list(base)
+        values[0] = ts
+        stats = node_stats(name, values)
+        stats["heartbeat"] = True
+        return stats
+
+    pass
+
+def encode_batch(name, frames, compress=True):
+    """One batch frame from name carrying the given frames."""
+    body = "".join(BATCH_ENTRY.pack(len(f)) + f for f in frames)
+    if compress:
+        return pack_header(MSG_BATCH, name, FLAG_ZLIB) + zlib.compress(body)
+    return pack_header(MSG_BATCH, name) + body
+
+def encode_batches(name, frames, compress=True, limit=BATCH_MAX):
+    """The frames packed into batch frames of at most limit bytes each, as
+    sent, so that no batch is fragmented. A frame larger than that on its
+    own gets a batch of its own."""
+    batches, pending = [], list(frames)
+    while pending:
+        n = len(pending)
+        while True:
+            batch = encode_batch(name, pending[:n], compress)
+            if len(batch) <= limit or n == 1:
+                break
+            # Shrink in proportion to the overshoot, as the compression
+            # ratio of the rest is about the same
+            n = min(max(int(n * 0.95 * limit / len(batch)), 1), n - 1)
+        batches.append(batch)
+        pending = pending[n:]
+    return batches
+
+def unpack_batch(data):
+    """The frames carried by a batch frame."""
+    mtype, flags, name, off = unpack_header(data)
+    body = data[off:]
+    if flags & FLAG_ZLIB:
+        d = zlib.decompressobj()
+        body = d.decompress(body, 2**16)
+        if d.unconsumed_tail:
+            raise WireError("oversized batch frame from %s" % name)
+    frames, off = [], 0
+    while off < len(body):
+        n = BATCH_ENTRY.unpack_from(body, off)[0]
+        off += BATCH_ENTRY.size
+        if off + n > len(body):
+            raise WireError("truncated batch frame from %s" % name)
+        frames.append(body[off:off+n])
+        off += n
+    return frames
+
+def encode_peer(peer):
+    """Encode one peer report of a BitTorrent experiment for btexp."""
+    flags = (1 if peer.get("fw") else 0) | (2 if peer.get("fr") else 0)
+    body = PEER_BODY.pack(peer["ac"], peer["uc"], peer["tc"], peer["ul_size"],
+                          peer["dl_size"], peer["ul_rate"], peer["dl_rate"], flags)
+    return pack_header(MSG_PEER, peer["node"]) + struct.pack("!B", len(peer["peer"])) + peer["peer"] + body
+
+def decode_peer(name, data, off):
+    n = ord(data[off])
+    peer = data[off+1:off+1+n]
+    ac, uc, tc, ul_size, dl_size, ul_rate, dl_rate, flags = PEER_BODY.unpack_from(data, off+1+n)
+    return { "type": "peer", "node": name, "peer": peer, "ac": ac, "uc": uc, "tc": tc,
+             "ul_size": ul_size, "dl_size": dl_size, "ul_rate": ul_rate,
+             "dl_rate": dl_rate, "fw": bool(flags & 1), "fr": bool(flags & 2) }
+
+def encode_register(addr):
+    """Encode the (ip, port) a listener wants the nodes to report to."""
+    ip, port = addr
+    return pack_header(MSG_REG, "") + REG_BODY.pack(socket.inet_aton(socket.gethostbyname(ip)), port)
+
+def decode_register(data):
+    if is_legacy(data):
+        return tuple(loads_legacy(data))
+    mtype, flags, name, off = unpack_header(data)
+    if mtype != MSG_REG:
+        raise WireError("not a registration frame")
+    ip, port = REG_BODY.unpack_from(data, off)
+    return (socket.inet_ntoa(ip), port)
+
+def encode_register_ack(name, addr):
+    """Encode a node's confirmation that the listener at addr is registered."""
+    ip, port = addr
+    return pack_header(MSG_REG_ACK, name) + REG_BODY.pack(socket.inet_aton(ip), port)
+
+def decode_register_ack(name, data, off):
+    ip, port = REG_BODY.unpack_from(data, off)
+    return { "type": "regack", "nodename": name, "addr": (socket.inet_ntoa(ip), port) }